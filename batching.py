@@ -0,0 +1,114 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future
+import tensorflow as tf
+
+# Dynamic micro-batching in front of MaskRCNN.detect(). Requests from
+# many threads are queued; a single worker thread collects up to
+# max_batch_size images, or whatever has arrived once max_wait_ms has
+# passed since the first image of the batch, and runs them through one
+# forward pass. Each caller gets its own result back through a Future.
+#
+# The model must be built with BATCH_SIZE >= max_batch_size
+# (see load_model(batch_size=...) in person_blocker.py).
+
+
+class BatchScheduler(object):
+
+    def __init__(self, model, max_batch_size=None, max_wait_ms=10.,
+                 detect_kwargs=None):
+        batch_size = model.config.BATCH_SIZE
+        self.model = model
+        self.max_batch_size = max_batch_size or batch_size
+        assert self.max_batch_size <= batch_size, \
+            "max_batch_size must be <= the model's BATCH_SIZE"
+        self.max_wait = max_wait_ms / 1000.
+        # Extra keyword arguments for detect(), e.g. sparse_masks=True
+        self.detect_kwargs = detect_kwargs or {}
+
+        # Keras/TF1 graphs are thread-local, so remember the graph the
+        # model was built in and run detection inside it.
+        self.graph = tf.get_default_graph()
+
+        # Statistics: number of forward passes and images processed
+        self.num_batches = 0
+        self.num_images = 0
+
+        self._queue = queue.Queue()
+        # Guards _closed, so that no image can be queued after the stop
+        # sentinel, where the worker would never get to it
+        self._lock = threading.Lock()
+        self._closed = False
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def submit(self, image):
+        """Queues one image and returns a Future with its detect() result.
+        Raises RuntimeError once the scheduler is closed.
+        """
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("BatchScheduler is closed")
+            self._queue.put((image, future))
+        return future
+
+    def detect(self, image, timeout=None):
+        """Blocking convenience wrapper around submit()."""
+        return self.submit(image).result(timeout)
+
+    def close(self):
+        """Stops the worker after the already queued images are done."""
+        with self._lock:
+            if not self._closed:
+                self._closed = True
+                self._queue.put(None)
+        self._worker.join()
+
+    def _collect(self):
+        # Block until the first request arrives, then wait at most
+        # max_wait for the batch to fill up.
+        item = self._queue.get()
+        if item is None:
+            return None
+        batch = [item]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.time()
+            try:
+                if remaining > 0:
+                    item = self._queue.get(timeout=remaining)
+                else:
+                    item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # Close requested. Finish this batch first.
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            images = [image for image, _ in batch]
+            futures = [future for _, future in batch]
+
+            # detect() pads a partial batch internally
+            try:
+                with self.graph.as_default():
+                    results = self.model.detect(images,
+                                                **self.detect_kwargs)
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+
+            self.num_batches += 1
+            self.num_images += len(images)
+            for future, result in zip(futures, results):
+                future.set_result(result)
@@ -0,0 +1,87 @@
+"""
+Throughput benchmark for the micro-batching scheduler (batching.py).
+
+Sweeps max batch size and max wait, firing requests from a number of
+concurrent client threads, and prints images/second plus p50/p99
+latency per setting. Run from the repository root:
+
+    python3 benchmarks/bench_batching.py -i images/img1.jpg \\
+        --batch-sizes 1 2 4 --waits 0 5 20 --clients 8 -n 32
+"""
+
+import os
+import sys
+import time
+import argparse
+import threading
+import numpy as np
+import imageio
+import keras.backend as K
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from person_blocker import load_model  # noqa: E402
+from batching import BatchScheduler  # noqa: E402
+
+
+def run_load(scheduler, image, num_requests, num_clients):
+    latencies = []
+    lock = threading.Lock()
+    counter = iter(range(num_requests))
+
+    def client():
+        while True:
+            with lock:
+                if next(counter, None) is None:
+                    return
+            start = time.time()
+            scheduler.detect(image)
+            elapsed = time.time() - start
+            with lock:
+                latencies.append(elapsed)
+
+    threads = [threading.Thread(target=client) for _ in range(num_clients)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.time() - start, np.array(latencies) * 1000.
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-i', '--image', required=True)
+    parser.add_argument('-m', '--model', default=None)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--waits', type=float, nargs='+', default=[0, 5, 20],
+                        help='max wait values in ms')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('-n', type=int, default=32,
+                        help='requests per setting')
+    args = parser.parse_args()
+
+    image = imageio.imread(args.image)
+
+    print('{:>6} {:>8} {:>10} {:>10} {:>10} {:>10}'.format(
+        'batch', 'wait_ms', 'img/s', 'p50_ms', 'p99_ms', 'avg_batch'))
+    for batch_size in args.batch_sizes:
+        # The graph is unrolled over the batch size, so each one needs
+        # its own model.
+        K.clear_session()
+        model = load_model(args.model, batch_size=batch_size)
+        for wait in args.waits:
+            scheduler = BatchScheduler(model, batch_size, wait)
+            # Warm-up pass so graph setup is not counted
+            scheduler.detect(image)
+            scheduler.num_batches = scheduler.num_images = 0
+
+            elapsed, latencies = run_load(scheduler, image, args.n,
+                                          args.clients)
+            scheduler.close()
+            print('{:6d} {:8.1f} {:10.2f} {:10.1f} {:10.1f} {:10.2f}'.format(
+                batch_size, wait, args.n / elapsed,
+                np.percentile(latencies, 50), np.percentile(latencies, 99),
+                scheduler.num_images / max(scheduler.num_batches, 1)))
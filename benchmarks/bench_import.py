@@ -0,0 +1,70 @@
+"""
+Import-time benchmark and regression guard for the CLI entry point.
+
+Times `person_blocker.py --names` and `--help` in fresh processes and
+checks that importing person_blocker doesn't load any of the heavy
+modules, which should only be imported once inference or visualization
+actually runs. Exits with an error if one of them is loaded, or if a
+command takes longer than --max-seconds. Run from the repository root:
+
+    python3 benchmarks/bench_import.py
+"""
+
+import os
+import sys
+import time
+import json
+import argparse
+import subprocess
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ['tensorflow', 'keras', 'matplotlib', 'scipy', 'skimage',
+                 'pycocotools', 'h5py', 'model', 'utils', 'visualize', 'coco']
+
+CHECK_IMPORTS = '''
+import sys, json
+import person_blocker
+print(json.dumps(sorted(set(name.split('.')[0] for name in sys.modules))))
+'''
+
+
+def best_time(command, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.time()
+        subprocess.check_call(command, cwd=ROOT_DIR,
+                              stdout=subprocess.DEVNULL)
+        times.append(time.time() - start)
+    return min(times)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-r', '--repeats', type=int, default=3)
+    parser.add_argument('--max-seconds', type=float, default=1.,
+                        help='fail if a command takes longer than this')
+    args = parser.parse_args()
+
+    failed = False
+    for flag in ['--names', '--help']:
+        elapsed = best_time([sys.executable, 'person_blocker.py', flag],
+                            args.repeats)
+        print('person_blocker.py {:8} {:6.2f}s'.format(flag, elapsed))
+        if elapsed > args.max_seconds:
+            print('  slower than {:.2f}s'.format(args.max_seconds))
+            failed = True
+
+    output = subprocess.check_output([sys.executable, '-c', CHECK_IMPORTS],
+                                     cwd=ROOT_DIR)
+    loaded = set(json.loads(output.decode('utf8').strip().splitlines()[-1]))
+    heavy = [name for name in HEAVY_MODULES if name in loaded]
+    if heavy:
+        print('import person_blocker loads: ' + ', '.join(heavy))
+        failed = True
+    else:
+        print('import person_blocker loads none of: ' +
+              ', '.join(HEAVY_MODULES))
+
+    sys.exit(1 if failed else 0)
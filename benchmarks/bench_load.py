@@ -0,0 +1,61 @@
+"""
+Cold start benchmark for loading the model weights.
+
+Builds the inference model and loads each given weights file in a fresh
+process, and prints the time spent in load_weights() and the peak RSS of
+the process. Compare an HDF5 file with its flat conversion
+(person_blocker.py --convert-weights). Run from the repository root:
+
+    python3 benchmarks/bench_load.py mask_rcnn_coco.h5 mask_rcnn_coco.weights
+"""
+
+import os
+import sys
+import time
+import json
+import argparse
+import resource
+import subprocess
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+
+def load_once(weights_path):
+    import model as modellib
+    from classes import InferenceConfig
+
+    start = time.time()
+    model = modellib.MaskRCNN(mode="inference", config=InferenceConfig(),
+                              model_dir=os.path.join(ROOT_DIR, "logs"))
+    built = time.time()
+    model.load_weights(weights_path, by_name=True)
+    loaded = time.time()
+    # ru_maxrss is in kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    print(json.dumps({'build_s': built - start, 'load_s': loaded - built,
+                      'peak_rss_mb': peak_rss}))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('weights', nargs='+')
+    parser.add_argument('--child', action='store_true',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        load_once(args.weights[0])
+        sys.exit()
+
+    print('{:40} {:>8} {:>8} {:>12}'.format(
+        'weights', 'build_s', 'load_s', 'peak_rss_mb'))
+    for weights_path in args.weights:
+        output = subprocess.check_output(
+            [sys.executable, os.path.abspath(__file__), '--child',
+             weights_path], cwd=ROOT_DIR)
+        result = json.loads(output.decode('utf8').strip().splitlines()[-1])
+        print('{:40} {:8.2f} {:8.2f} {:12.1f}'.format(
+            os.path.basename(weights_path), result['build_s'],
+            result['load_s'], result['peak_rss_mb']))
@@ -0,0 +1,91 @@
+"""
+Benchmark for molding images into the network's input batch.
+
+For each resize backend (utils.RESIZE_BACKENDS), times resizing alone and
+MaskRCNN.mold_inputs() on a full batch, next to the previous molding
+path: resize to uint8, subtract the float64 mean pixel per image, then
+stack and pad the batch. Run from the repository root:
+
+    python3 benchmarks/bench_mold.py --height 720 --width 1280 --batch-size 2
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import utils  # noqa: E402
+import model as modellib  # noqa: E402
+from classes import InferenceConfig  # noqa: E402
+
+
+class MoldOnly(object):
+    # mold_inputs() only needs the config, so skip building the model
+    def __init__(self, config):
+        self.config = config
+
+
+def mold_inputs_previous(images, config):
+    molded_images = []
+    for image in images:
+        molded_image, _, _, _ = utils.resize_image(
+            image, min_dim=config.IMAGE_MIN_DIM, max_dim=config.IMAGE_MAX_DIM,
+            padding=config.IMAGE_PADDING, backend="pil")
+        molded_images.append(molded_image.astype(np.float32) -
+                             config.MEAN_PIXEL)
+    molded_images = np.stack(molded_images)
+    padding = config.BATCH_SIZE - len(images)
+    if padding:
+        molded_images = np.concatenate(
+            [molded_images, np.repeat(molded_images[-1:], padding, axis=0)])
+    return molded_images
+
+
+def best_time(fn, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+    return min(times) * 1000.
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--backends', nargs='+',
+                        default=sorted(utils.RESIZE_BACKENDS))
+    parser.add_argument('-r', '--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    images = [rng.randint(0, 256, (args.height, args.width, 3), dtype=np.uint8)
+              for _ in range(args.batch_size)]
+    config = InferenceConfig(images_per_gpu=args.batch_size)
+    size, _, _, _ = utils.resize_geometry(
+        args.height, args.width, config.IMAGE_MIN_DIM, config.IMAGE_MAX_DIM,
+        config.IMAGE_PADDING)
+
+    print('{:>10} {:>10} {:>10}'.format('backend', 'resize_ms', 'mold_ms'))
+    previous = best_time(lambda: mold_inputs_previous(images, config),
+                         args.repeats)
+    print('{:>10} {:>10} {:10.1f}'.format('previous', '', previous))
+    for backend in args.backends:
+        config.RESIZE_BACKEND = backend
+        try:
+            resize = best_time(lambda: utils.resize(images[0], size, backend),
+                               args.repeats)
+        except ImportError as e:
+            print('{:>10} skipped: {}'.format(backend, e))
+            continue
+        mold = best_time(lambda: modellib.MaskRCNN.mold_inputs(
+            MoldOnly(config), images, batch_size=config.BATCH_SIZE),
+            args.repeats)
+        print('{:>10} {:10.1f} {:10.1f}'.format(backend, resize, mold))
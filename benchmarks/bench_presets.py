@@ -0,0 +1,75 @@
+"""
+Latency and detection count of the inference presets.
+
+Runs detect() on each sample image with the model built for each preset
+(classes.INFERENCE_PRESETS), and prints the mean latency per image and
+the number of detections, with the change of both relative to the
+baseline preset. Run from the repository root:
+
+    python3 benchmarks/bench_presets.py -i images/*.jpg
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import imageio
+import keras.backend as K
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from person_blocker import load_model  # noqa: E402
+from classes import INFERENCE_PRESETS  # noqa: E402
+
+
+def run_preset(model_path, preset, images, repeats):
+    # Each preset builds a different graph
+    K.clear_session()
+    model = load_model(model_path, preset=preset)
+    # Warm-up pass so graph setup is not counted
+    model.detect(images[:1])
+
+    latencies = []
+    detections = 0
+    for image in images:
+        times = []
+        for _ in range(repeats):
+            start = time.time()
+            r = model.detect([image])[0]
+            times.append(time.time() - start)
+        latencies.append(min(times) * 1000.)
+        detections += len(r['class_ids'])
+    return np.mean(latencies), detections
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-i', '--images', nargs='+', required=True)
+    parser.add_argument('-m', '--model', default=None)
+    parser.add_argument('--presets', nargs='+', choices=list(INFERENCE_PRESETS),
+                        default=list(INFERENCE_PRESETS))
+    parser.add_argument('--baseline', choices=list(INFERENCE_PRESETS),
+                        default='accurate')
+    parser.add_argument('-r', '--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    images = [imageio.imread(path) for path in args.images]
+    presets = args.presets
+    if args.baseline not in presets:
+        presets = presets + [args.baseline]
+    results = {preset: run_preset(args.model, preset, images, args.repeats)
+               for preset in presets}
+
+    base_ms, base_detections = results[args.baseline]
+    print('{} images, deltas relative to {}'.format(len(images),
+                                                    args.baseline))
+    print('{:>10} {:>10} {:>10} {:>8} {:>10} {:>8}'.format(
+        'preset', 'mean_ms', 'delta_ms', 'delta%', 'detections', 'delta'))
+    for preset in presets:
+        ms, detections = results[preset]
+        print('{:>10} {:10.1f} {:+10.1f} {:+7.1f}% {:10d} {:+8d}'.format(
+            preset, ms, ms - base_ms, 100. * (ms - base_ms) / base_ms,
+            detections, detections - base_detections))
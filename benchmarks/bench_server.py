@@ -0,0 +1,78 @@
+"""
+Latency benchmark: server.py (warm model) vs. person_blocker.py (cold CLI).
+
+Start the server first:
+
+    python3 server.py -m mask_rcnn_coco.h5
+
+Then run from the repository root:
+
+    python3 benchmarks/bench_server.py -i images/img1.jpg -n 50 --cli-runs 3
+"""
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+import numpy as np
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from client import block_remote  # noqa: E402
+
+
+def summarize(name, latencies):
+    latencies = np.array(latencies) * 1000.
+    print('{:10} n={:<4d} p50={:9.1f} ms  p99={:9.1f} ms  mean={:9.1f} ms'.format(
+        name, len(latencies), np.percentile(latencies, 50),
+        np.percentile(latencies, 99), latencies.mean()))
+
+
+def bench_server(args):
+    # Warm-up request so one-time TF graph setup is not counted
+    block_remote(args.image, output_format=args.format,
+                 host=args.host, port=args.port)
+    latencies = []
+    for _ in range(args.n):
+        start = time.time()
+        block_remote(args.image, output_format=args.format,
+                     host=args.host, port=args.port)
+        latencies.append(time.time() - start)
+    return latencies
+
+
+def bench_cli(args):
+    command = [sys.executable, os.path.join(ROOT_DIR, 'person_blocker.py'),
+               '-i', os.path.abspath(args.image)]
+    if args.model:
+        command += ['-m', os.path.abspath(args.model)]
+    latencies = []
+    for _ in range(args.cli_runs):
+        start = time.time()
+        subprocess.check_call(command, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+        latencies.append(time.time() - start)
+    return latencies
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-i', '--image', required=True)
+    parser.add_argument('-m', '--model', default=None,
+                        help='path to COCO model (CLI runs only)')
+    parser.add_argument('-n', type=int, default=20,
+                        help='number of server requests')
+    parser.add_argument('--cli-runs', type=int, default=0,
+                        help='number of CLI runs to compare against')
+    parser.add_argument('-f', '--format', default='png',
+                        choices=['png', 'gif', 'mask'])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=5000)
+    args = parser.parse_args()
+
+    summarize('server', bench_server(args))
+    if args.cli_runs:
+        summarize('cli', bench_cli(args))
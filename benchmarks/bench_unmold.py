@@ -0,0 +1,87 @@
+"""
+Microbenchmark for pasting instance masks back into the image frame.
+
+Compares the previous per-instance loop (resize each 28x28 mask through
+an 8-bit image round trip, paste it into its own full-size frame, then
+stack) against utils.unmold_masks(), dense and sparse, at a few instance
+counts. Run from the repository root:
+
+    python3 benchmarks/bench_unmold.py --instances 10 50 100
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+from PIL import Image
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import utils  # noqa: E402
+
+
+def unmold_mask_loop(mask, bbox, image_shape):
+    # The old utils.unmold_mask(): scipy.misc.imresize() was a thin
+    # wrapper around PIL that rescaled the mask to uint8 first.
+    y1, x1, y2, x2 = bbox
+    mask = Image.fromarray((mask * 255).astype(np.uint8))
+    mask = np.array(mask.resize((x2 - x1, y2 - y1), Image.BILINEAR))
+    mask = np.where(mask.astype(np.float32) / 255.0 >= 0.5, 1, 0)
+    full_mask = np.zeros(image_shape[:2], dtype=np.uint8)
+    full_mask[y1:y2, x1:x2] = mask
+    return full_mask
+
+
+def unmold_masks_loop(masks, boxes, image_shape):
+    full_masks = [unmold_mask_loop(mask, box, image_shape)
+                  for mask, box in zip(masks, boxes)]
+    return np.stack(full_masks, axis=-1)
+
+
+def random_instances(count, image_shape, rng):
+    height, width = image_shape[:2]
+    masks = rng.rand(count, 28, 28).astype(np.float32)
+    sizes = rng.randint(16, min(height, width) // 2, size=(count, 2))
+    y1 = rng.randint(0, height - sizes[:, 0])
+    x1 = rng.randint(0, width - sizes[:, 1])
+    boxes = np.stack([y1, x1, y1 + sizes[:, 0], x1 + sizes[:, 1]], axis=1)
+    return masks, boxes.astype(np.int32)
+
+
+def best_time(fn, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+    return min(times) * 1000.
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--instances', type=int, nargs='+',
+                        default=[10, 50, 100])
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('-r', '--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    image_shape = (args.height, args.width, 3)
+    rng = np.random.RandomState(0)
+
+    print('{:>9} {:>10} {:>10} {:>10} {:>8}'.format(
+        'instances', 'loop_ms', 'dense_ms', 'sparse_ms', 'speedup'))
+    for count in args.instances:
+        masks, boxes = random_instances(count, image_shape, rng)
+        loop = best_time(
+            lambda: unmold_masks_loop(masks, boxes, image_shape), args.repeats)
+        dense = best_time(
+            lambda: utils.unmold_masks(masks, boxes, image_shape), args.repeats)
+        sparse = best_time(
+            lambda: utils.unmold_masks(masks, boxes, image_shape, sparse=True),
+            args.repeats)
+        print('{:9d} {:10.2f} {:10.2f} {:10.2f} {:7.1f}x'.format(
+            count, loop, dense, sparse, loop / dense))
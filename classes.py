@@ -1,5 +1,6 @@
 import numpy as np
-import coco
+from collections import OrderedDict
+from config import Config
 
 
 def get_class_names():
@@ -20,6 +21,63 @@ def get_class_names():
                      'teddy bear', 'hair drier', 'toothbrush'])
 
 
-class InferenceConfig(coco.CocoConfig):
+# Named speed/accuracy trade-offs for InferenceConfig(preset=...), as
+# config settings. 'accurate' is the configuration the model was trained
+# with. The others run smaller images that keep their aspect ratio, and
+# keep fewer proposals and detections. The backbone isn't part of any
+# preset, since it has to match the weights.
+INFERENCE_PRESETS = OrderedDict([
+    ('fast', {
+        'IMAGE_MIN_DIM': 448,
+        'IMAGE_MAX_DIM': 512,
+        'IMAGE_PADDING': False,
+        'PRE_NMS_LIMIT': 1000,
+        'POST_NMS_ROIS_INFERENCE': 300,
+        'DETECTION_MAX_INSTANCES': 30,
+    }),
+    ('balanced', {
+        'IMAGE_MIN_DIM': 640,
+        'IMAGE_MAX_DIM': 768,
+        'IMAGE_PADDING': False,
+        'PRE_NMS_LIMIT': 3000,
+        'POST_NMS_ROIS_INFERENCE': 500,
+        'DETECTION_MAX_INSTANCES': 50,
+    }),
+    ('accurate', {}),
+])
+
+
+# The COCO settings the pretrained model was trained with (see
+# coco.CocoConfig), without importing coco.py and with it TensorFlow and
+# pycocotools.
+
+class InferenceConfig(Config):
+    NAME = "coco"
+    NUM_CLASSES = len(get_class_names())
     GPU_COUNT = 1
     IMAGES_PER_GPU = 1
+    # Only copy each detection's own class mask out of the graph
+    DETECTION_MASK_GATHER = True
+    # and don't return tensors detect() doesn't use
+    DETECTION_SLIM_OUTPUTS = True
+
+    def __init__(self, images_per_gpu=None, class_ids=None, preset=None,
+                 overrides=None):
+        # Allow a larger batch for callers that run several images
+        # through one forward pass (see batching.py)
+        if images_per_gpu:
+            self.IMAGES_PER_GPU = images_per_gpu
+        # Optionally build the heads for only these classes
+        if class_ids is not None and len(class_ids):
+            self.INFERENCE_CLASS_IDS = [int(i) for i in class_ids]
+        # Apply a named preset, then individual settings on top of it
+        if preset is not None and preset not in INFERENCE_PRESETS:
+            raise ValueError('Unknown preset {}, use one of: {}'.format(
+                preset, ', '.join(INFERENCE_PRESETS)))
+        settings = dict(INFERENCE_PRESETS[preset]) if preset else {}
+        settings.update(overrides or {})
+        for name, value in settings.items():
+            if not hasattr(self, name):
+                raise ValueError('Unknown config setting ' + name)
+            setattr(self, name, value)
+        super(InferenceConfig, self).__init__()
@@ -0,0 +1,57 @@
+import sys
+import argparse
+import urllib.request
+from urllib.parse import urlencode
+
+# Minimal client for server.py. Sends an image to a running server
+# and returns the blocked PNG/GIF (or mask PNG) bytes.
+
+
+def block_remote(image_path, objects=('person',), color='(255, 255, 255)',
+                 output_format='png', host='127.0.0.1', port=5000,
+                 timeout=60):
+
+    query = urlencode([('objects', o) for o in objects] +
+                      [('color', color), ('format', output_format)])
+    url = 'http://{}:{}/block?{}'.format(host, port, query)
+
+    with open(image_path, 'rb') as f:
+        data = f.read()
+
+    request = urllib.request.Request(
+        url, data=data, method='POST',
+        headers={'Content-Type': 'application/octet-stream'})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return response.read()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Send an image to a running Person Blocker server.')
+    parser.add_argument('-i', '--image', help='Image file name.',
+                        required=True)
+    parser.add_argument('-o',
+                        '--objects', nargs='+',
+                        help='object(s)/object ID(s) to block.',
+                        default=['person'])
+    parser.add_argument('-c',
+                        '--color', nargs='?', default='(255, 255, 255)',
+                        help='color of the "block"')
+    parser.add_argument('-f', '--format', dest='output_format',
+                        choices=['png', 'gif', 'mask'], default='png',
+                        help='output format')
+    parser.add_argument('--output', default=None,
+                        help='output file name (default: '
+                        'person_blocked.<format>)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=5000)
+    args = parser.parse_args()
+
+    body = block_remote(args.image, args.objects, args.color,
+                        args.output_format, args.host, args.port)
+
+    extension = 'gif' if args.output_format == 'gif' else 'png'
+    output = args.output or 'person_blocked.' + extension
+    with open(output, 'wb') as f:
+        f.write(body)
+    print('Wrote {} ({} bytes)'.format(output, len(body)), file=sys.stderr)
@@ -311,6 +311,8 @@ class CocoDataset(utils.Dataset):
 
 def build_coco_results(dataset, image_ids, rois, class_ids, scores, masks):
     """Arrange resutls to match COCO specs in http://cocodataset.org/#format
+
+    masks: [height, width, N] array or utils.InstanceMasks
     """
     # If no results, return an empty list
     if rois is None:
@@ -71,6 +71,13 @@ class Config(object):
     # If 2, then anchors are created for every other cell, and so on.
     RPN_ANCHOR_STRIDE = 1
 
+    # Anchors are generated once per image size and anchor settings, and
+    # the ANCHOR_CACHE_SIZE most recently used sets are kept in memory.
+    # If ANCHOR_CACHE_DIR is set, they're also saved there as .npy files
+    # that later runs load instead of generating them again.
+    ANCHOR_CACHE_SIZE = 8
+    ANCHOR_CACHE_DIR = None
+
     # Non-max suppression threshold to filter RPN proposals.
     # You can reduce this during training to generate more propsals.
     RPN_NMS_THRESHOLD = 0.7
@@ -78,6 +85,10 @@ class Config(object):
     # How many anchors per image to use for RPN training
     RPN_TRAIN_ANCHORS_PER_IMAGE = 256
 
+    # Anchors with the highest scores kept before non-maximum suppression
+    # of the RPN proposals (training and inference)
+    PRE_NMS_LIMIT = 6000
+
     # ROIs kept after non-maximum supression (training and inference)
     POST_NMS_ROIS_TRAINING = 2000
     POST_NMS_ROIS_INFERENCE = 1000
@@ -94,7 +105,15 @@ class Config(object):
     IMAGE_MIN_DIM = 800
     IMAGE_MAX_DIM = 1024
     # If True, pad images with zeros such that they're (max_dim by max_dim)
-    IMAGE_PADDING = True  # currently, the False option is not supported
+    # If False, images keep their aspect ratio and are only padded up to a
+    # multiple of 64, which saves the backbone the work on the padding.
+    # False is only supported for inference.
+    IMAGE_PADDING = True
+
+    # How images are resized to IMAGE_MIN_DIM/IMAGE_MAX_DIM, one of
+    # utils.RESIZE_BACKENDS: "pil" (bilinear), "skimage" (bilinear) or
+    # "area" (area averaging in pure NumPy)
+    RESIZE_BACKEND = "pil"
 
     # Image mean (RGB)
     MEAN_PIXEL = np.array([123.7, 116.8, 103.9])
@@ -131,6 +150,33 @@ class Config(object):
     # Non-maximum suppression threshold for detection
     DETECTION_NMS_THRESHOLD = 0.3
 
+    # Inference only. If True, the graph picks the mask channel of each
+    # detection's predicted class, so that mrcnn_mask comes out as
+    # [batch, detections, 28, 28] rather than with all NUM_CLASSES
+    # channels. Saves most of the copy out of TensorFlow.
+    DETECTION_MASK_GATHER = False
+    # Inference only, used with DETECTION_MASK_GATHER. If set (e.g. 0.5),
+    # the small masks are binarized in the graph and returned as uint8.
+    # Smaller again, but the mask edges are interpolated from the
+    # binary mask rather than from the probabilities.
+    DETECTION_MASK_THRESHOLD = None
+
+    # Inference only. If True, the inference model outputs just
+    # [detections, mrcnn_mask] instead of also returning mrcnn_class,
+    # mrcnn_bbox, rpn_rois, rpn_class and rpn_bbox, which detect() doesn't
+    # use and which are costly to copy out (rpn_* cover every anchor).
+    # Use run_graph() to inspect intermediate tensors.
+    DETECTION_SLIM_OUTPUTS = False
+
+    # Inference only. Optional list of class IDs, e.g. [1] for COCO's
+    # person, to build the classifier, box and mask heads for. The final
+    # layers of those heads are sliced from the full weights when they're
+    # loaded, and detect() still returns the original class IDs.
+    # Note that class scores are normalized over background and these
+    # classes only, so objects of other classes may be detected as one of
+    # them. Raising DETECTION_MIN_CONFIDENCE limits that.
+    INFERENCE_CLASS_IDS = None
+
     # Learning rate and momentum
     # The Mask RCNN paper uses lr=0.02, but on TensorFlow it causes
     # weights to explode. Likely due to differences in optimzer
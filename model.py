@@ -29,6 +29,7 @@ import keras.engine as KE
 import keras.models as KM
 
 import utils
+import profiling
 
 # Requires TensorFlow 1.3+ and Keras 2.0.8+.
 from distutils.version import LooseVersion
@@ -233,6 +234,10 @@ class ProposalLayer(KE.Layer):
     Inputs:
         rpn_probs: [batch, anchors, (bg prob, fg prob)]
         rpn_bbox: [batch, anchors, (dy, dx, log(dh), log(dw))]
+        anchors: (only if the layer was created with anchors=None)
+            [batch, anchors, (y1, x1, y2, x2)] in image coordinates
+        input_image: (only if the layer was created with anchors=None)
+            the molded images, to read the image size from
 
     Returns:
         Proposals in normalized coordinates [batch, rois, (y1, x1, y2, x2)]
@@ -241,13 +246,16 @@ class ProposalLayer(KE.Layer):
     def __init__(self, proposal_count, nms_threshold, anchors,
                  config=None, **kwargs):
         """
-        anchors: [N, (y1, x1, y2, x2)] anchors defined in image coordinates
+        anchors: [N, (y1, x1, y2, x2)] anchors defined in image coordinates,
+            or None if the input size isn't fixed and the anchors for it
+            are given as inputs of the layer instead.
         """
         super(ProposalLayer, self).__init__(**kwargs)
         self.config = config
         self.proposal_count = proposal_count
         self.nms_threshold = nms_threshold
-        self.anchors = anchors.astype(np.float32)
+        self.anchors = anchors.astype(np.float32) \
+            if anchors is not None else None
 
     def call(self, inputs):
         # Box Scores. Use the foreground class confidence. [Batch, num_rois, 1]
@@ -255,21 +263,37 @@ class ProposalLayer(KE.Layer):
         # Box deltas [batch, num_rois, 4]
         deltas = inputs[1]
         deltas = deltas * np.reshape(self.config.RPN_BBOX_STD_DEV, [1, 1, 4])
-        # Base anchors
-        anchors = self.anchors
 
         # Improve performance by trimming to top anchors by score
         # and doing the rest on the smaller subset.
-        pre_nms_limit = min(6000, self.anchors.shape[0])
+        if self.anchors is not None:
+            # Base anchors, the same for every image
+            anchors = self.anchors
+            pre_nms_limit = min(self.config.PRE_NMS_LIMIT,
+                                self.anchors.shape[0])
+            height, width = [float(x) for x in self.config.IMAGE_SHAPE[:2]]
+        else:
+            # Anchors for the size of this batch, and the size itself
+            anchors = inputs[2]
+            pre_nms_limit = tf.minimum(self.config.PRE_NMS_LIMIT,
+                                       tf.shape(anchors)[1])
+            image_shape = tf.cast(tf.shape(inputs[3])[1:3], tf.float32)
+            height, width = image_shape[0], image_shape[1]
         ix = tf.nn.top_k(scores, pre_nms_limit, sorted=True,
                          name="top_anchors").indices
         scores = utils.batch_slice([scores, ix], lambda x, y: tf.gather(x, y),
                                    self.config.IMAGES_PER_GPU)
         deltas = utils.batch_slice([deltas, ix], lambda x, y: tf.gather(x, y),
                                    self.config.IMAGES_PER_GPU)
-        anchors = utils.batch_slice(ix, lambda x: tf.gather(anchors, x),
-                                    self.config.IMAGES_PER_GPU,
-                                    names=["pre_nms_anchors"])
+        if self.anchors is not None:
+            anchors = utils.batch_slice(ix, lambda x: tf.gather(anchors, x),
+                                        self.config.IMAGES_PER_GPU,
+                                        names=["pre_nms_anchors"])
+        else:
+            anchors = utils.batch_slice([anchors, ix],
+                                        lambda a, x: tf.gather(a, x),
+                                        self.config.IMAGES_PER_GPU,
+                                        names=["pre_nms_anchors"])
 
         # Apply deltas to anchors to get refined anchors.
         # [batch, N, (y1, x1, y2, x2)]
@@ -279,8 +303,7 @@ class ProposalLayer(KE.Layer):
                                   names=["refined_anchors"])
 
         # Clip to image boundaries. [batch, N, (y1, x1, y2, x2)]
-        height, width = self.config.IMAGE_SHAPE[:2]
-        window = np.array([0, 0, height, width]).astype(np.float32)
+        window = tf.stack([0., 0., height, width])
         boxes = utils.batch_slice(boxes,
                                   lambda x: clip_boxes_graph(x, window),
                                   self.config.IMAGES_PER_GPU,
@@ -291,7 +314,7 @@ class ProposalLayer(KE.Layer):
         # for small objects, so we're skipping it.
 
         # Normalize dimensions to range of 0 to 1.
-        normalized_boxes = boxes / np.array([[height, width, height, width]])
+        normalized_boxes = boxes / tf.stack([height, width, height, width])
 
         # Non-max suppression
         def nms(normalized_boxes, scores):
@@ -325,12 +348,15 @@ class PyramidROIAlign(KE.Layer):
 
     Params:
     - pool_shape: [height, width] of the output pooled regions. Usually [7, 7]
-    - image_shape: [height, width, channels]. Shape of input image in pixels
+    - image_shape: [height, width, channels]. Shape of input image in pixels,
+                   or None if the input size isn't fixed.
 
     Inputs:
     - boxes: [batch, num_boxes, (y1, x1, y2, x2)] in normalized
              coordinates. Possibly padded with zeros if not enough
              boxes to fill the array.
+    - input_image: Only if image_shape is None. The molded images, to read
+                   the image size from.
     - Feature maps: List of feature maps from different levels of the pyramid.
                     Each is [batch, height, width, channels]
 
@@ -343,7 +369,8 @@ class PyramidROIAlign(KE.Layer):
     def __init__(self, pool_shape, image_shape, **kwargs):
         super(PyramidROIAlign, self).__init__(**kwargs)
         self.pool_shape = tuple(pool_shape)
-        self.image_shape = tuple(image_shape)
+        self.image_shape = tuple(image_shape) \
+            if image_shape is not None else None
 
     def call(self, inputs):
         # Crop boxes [batch, num_boxes, (y1, x1, y2, x2)] in normalized coords
@@ -351,7 +378,12 @@ class PyramidROIAlign(KE.Layer):
 
         # Feature Maps. List of feature maps from different level of the
         # feature pyramid. Each is [batch, height, width, channels]
-        feature_maps = inputs[1:]
+        if self.image_shape is not None:
+            image_shape = self.image_shape
+            feature_maps = inputs[1:]
+        else:
+            image_shape = tf.shape(inputs[1])[1:3]
+            feature_maps = inputs[2:]
 
         # Assign each ROI to a level in the pyramid based on the ROI area.
         y1, x1, y2, x2 = tf.split(boxes, 4, axis=2)
@@ -361,7 +393,7 @@ class PyramidROIAlign(KE.Layer):
         # the fact that our coordinates are normalized here.
         # e.g. a 224x224 ROI (in pixels) maps to P4
         image_area = tf.cast(
-            self.image_shape[0] * self.image_shape[1], tf.float32)
+            image_shape[0] * image_shape[1], tf.float32)
         roi_level = log2_graph(tf.sqrt(h * w) / (224.0 / tf.sqrt(image_area)))
         roi_level = tf.minimum(5, tf.maximum(
             2, 4 + tf.cast(tf.round(roi_level), tf.int32)))
@@ -421,7 +453,7 @@ class PyramidROIAlign(KE.Layer):
         return pooled
 
     def compute_output_shape(self, input_shape):
-        return input_shape[0][:2] + self.pool_shape + (input_shape[1][-1], )
+        return input_shape[0][:2] + self.pool_shape + (input_shape[-1][-1], )
 
 
 ############################################################
@@ -667,7 +699,8 @@ def clip_to_window(window, boxes):
     return boxes
 
 
-def refine_detections_graph(rois, probs, deltas, window, config):
+def refine_detections_graph(rois, probs, deltas, window, config,
+                            image_shape=None):
     """Refine classified proposals and filter overlaps and return final
     detections.
 
@@ -678,6 +711,8 @@ def refine_detections_graph(rois, probs, deltas, window, config):
                 bounding box deltas.
         window: (y1, x1, y2, x2) in image coordinates. The part of the image
             that contains the image excluding the padding.
+        image_shape: (height, width) float tensor of the molded image size if
+            it isn't fixed. Defaults to config.IMAGE_SHAPE.
 
     Returns detections shaped: [N, (y1, x1, y2, x2, class_id, score)] where
         coordinates are in image domain.
@@ -695,8 +730,13 @@ def refine_detections_graph(rois, probs, deltas, window, config):
         rois, deltas_specific * config.BBOX_STD_DEV)
     # Convert coordiates to image domain
     # TODO: better to keep them normalized until later
-    height, width = config.IMAGE_SHAPE[:2]
-    refined_rois *= tf.constant([height, width, height, width], dtype=tf.float32)
+    if image_shape is None:
+        height, width = config.IMAGE_SHAPE[:2]
+        refined_rois *= tf.constant([height, width, height, width],
+                                    dtype=tf.float32)
+    else:
+        height, width = image_shape[0], image_shape[1]
+        refined_rois *= tf.stack([height, width, height, width])
     # Clip boxes to image window
     refined_rois = clip_boxes_graph(refined_rois, window)
     # Round and cast to int since we're deadling with pixels now
@@ -775,6 +815,9 @@ class DetectionLayer(KE.Layer):
     """Takes classified proposal boxes and their bounding box deltas and
     returns the final detection boxes.
 
+    Inputs are the rois, mrcnn_class, mrcnn_bbox and image_meta tensors, and,
+    if the input size isn't fixed, the molded images to read the size from.
+
     Returns:
     [batch, num_detections, (y1, x1, y2, x2, class_id, class_score)] where
     coordinates are in image domain
@@ -789,12 +832,16 @@ class DetectionLayer(KE.Layer):
         mrcnn_class = inputs[1]
         mrcnn_bbox = inputs[2]
         image_meta = inputs[3]
+        image_shape = None
+        if len(inputs) > 4:
+            image_shape = tf.cast(tf.shape(inputs[4])[1:3], tf.float32)
 
         # Run detection refinement graph on each item in the batch
         _, _, window, _ = parse_image_meta_graph(image_meta)
         detections_batch = utils.batch_slice(
             [rois, mrcnn_class, mrcnn_bbox, window],
-            lambda x, y, w, z: refine_detections_graph(x, y, w, z, self.config),
+            lambda x, y, w, z: refine_detections_graph(x, y, w, z, self.config,
+                                                       image_shape),
             self.config.IMAGES_PER_GPU)
 
         # Reshape output
@@ -880,7 +927,8 @@ def build_rpn_model(anchor_stride, anchors_per_location, depth):
 ############################################################
 
 def fpn_classifier_graph(rois, feature_maps,
-                         image_shape, pool_size, num_classes):
+                         image_shape, pool_size, num_classes,
+                         input_image=None):
     """Builds the computation graph of the feature pyramid network classifier
     and regressor heads.
 
@@ -888,9 +936,11 @@ def fpn_classifier_graph(rois, feature_maps,
           coordinates.
     feature_maps: List of feature maps from diffent layers of the pyramid,
                   [P2, P3, P4, P5]. Each has a different resolution.
-    image_shape: [height, width, depth]
+    image_shape: [height, width, depth], or None if the input size isn't
+                 fixed, to read it from input_image instead.
     pool_size: The width of the square feature map generated from ROI Pooling.
     num_classes: number of classes, which determines the depth of the results
+    input_image: The molded images. Only used if image_shape is None.
 
     Returns:
         logits: [N, NUM_CLASSES] classifier logits (before softmax)
@@ -901,7 +951,9 @@ def fpn_classifier_graph(rois, feature_maps,
     # ROI Pooling
     # Shape: [batch, num_boxes, pool_height, pool_width, channels]
     x = PyramidROIAlign([pool_size, pool_size], image_shape,
-                        name="roi_align_classifier")([rois] + feature_maps)
+                        name="roi_align_classifier")(
+        [rois] + ([input_image] if image_shape is None else []) +
+        feature_maps)
     # Two 1024 FC layers (implemented with Conv2D for consistency)
     x = KL.TimeDistributed(KL.Conv2D(1024, (pool_size, pool_size), padding="valid"),
                            name="mrcnn_class_conv1")(x)
@@ -934,23 +986,28 @@ def fpn_classifier_graph(rois, feature_maps,
 
 
 def build_fpn_mask_graph(rois, feature_maps,
-                         image_shape, pool_size, num_classes):
+                         image_shape, pool_size, num_classes,
+                         input_image=None):
     """Builds the computation graph of the mask head of Feature Pyramid Network.
 
     rois: [batch, num_rois, (y1, x1, y2, x2)] Proposal boxes in normalized
           coordinates.
     feature_maps: List of feature maps from diffent layers of the pyramid,
                   [P2, P3, P4, P5]. Each has a different resolution.
-    image_shape: [height, width, depth]
+    image_shape: [height, width, depth], or None if the input size isn't
+                 fixed, to read it from input_image instead.
     pool_size: The width of the square feature map generated from ROI Pooling.
     num_classes: number of classes, which determines the depth of the results
+    input_image: The molded images. Only used if image_shape is None.
 
     Returns: Masks [batch, roi_count, height, width, num_classes]
     """
     # ROI Pooling
     # Shape: [batch, boxes, pool_height, pool_width, channels]
     x = PyramidROIAlign([pool_size, pool_size], image_shape,
-                        name="roi_align_mask")([rois] + feature_maps)
+                        name="roi_align_mask")(
+        [rois] + ([input_image] if image_shape is None else []) +
+        feature_maps)
 
     # Conv layers
     x = KL.TimeDistributed(KL.Conv2D(256, (3, 3), padding="same"),
@@ -984,6 +1041,31 @@ def build_fpn_mask_graph(rois, feature_maps,
     return x
 
 
+def gather_detection_masks_graph(detections, mrcnn_mask, threshold=None):
+    """Picks the mask of each detection's predicted class, so that only
+    one channel per detection has to be copied out of the graph.
+
+    detections: [batch, num_detections, (y1, x1, y2, x2, class_id, score)]
+    mrcnn_mask: [batch, num_detections, height, width, num_classes]
+    threshold: Optional. If set, masks are binarized at this value and
+        returned as uint8 (0 or 1) instead of float32 probabilities.
+
+    Returns: Masks [batch, num_detections, height, width]
+    """
+    class_ids = tf.cast(detections[:, :, 4], tf.int32)
+    shape = tf.shape(class_ids)
+    batch_ix = tf.tile(tf.expand_dims(tf.range(shape[0]), 1), [1, shape[1]])
+    detection_ix = tf.tile(tf.expand_dims(tf.range(shape[1]), 0),
+                           [shape[0], 1])
+    indices = tf.stack([batch_ix, detection_ix, class_ids], axis=2)
+    # [batch, num_detections, num_classes, height, width]
+    masks = tf.transpose(mrcnn_mask, [0, 1, 4, 2, 3])
+    masks = tf.gather_nd(masks, indices)
+    if threshold is not None:
+        masks = tf.cast(masks >= threshold, tf.uint8)
+    return masks
+
+
 ############################################################
 #  Loss Functions
 ############################################################
@@ -1194,7 +1276,8 @@ def load_image_gt(dataset, config, image_id, augment=False,
         image,
         min_dim=config.IMAGE_MIN_DIM,
         max_dim=config.IMAGE_MAX_DIM,
-        padding=config.IMAGE_PADDING)
+        padding=config.IMAGE_PADDING,
+        backend=config.RESIZE_BACKEND)
     mask = utils.resize_mask(mask, scale, padding)
 
     # Random horizontal flips.
@@ -1574,7 +1657,7 @@ def generate_random_rois(image_shape, count, gt_class_ids, gt_boxes):
 
 
 def data_generator(dataset, config, shuffle=True, augment=True, random_rois=0,
-                   batch_size=1, detection_targets=False):
+                   batch_size=1, detection_targets=False, anchor_cache=None):
     """A generator that returns images and corresponding target class ids,
     bounding box deltas, and masks.
 
@@ -1590,6 +1673,8 @@ def data_generator(dataset, config, shuffle=True, augment=True, random_rois=0,
     detection_targets: If True, generate detection targets (class IDs, bbox
         deltas, and masks). Typically for debugging or visualizations because
         in trainig detection targets are generated by DetectionTargetLayer.
+    anchor_cache: Optional utils.AnchorCache to get the anchors from, e.g.
+        the one of the model, so that they're only generated once.
 
     Returns a Python generator. Upon calling next() on it, the
     generator returns two lists, inputs and outputs. The containtes
@@ -1616,11 +1701,14 @@ def data_generator(dataset, config, shuffle=True, augment=True, random_rois=0,
 
     # Anchors
     # [anchor_count, (y1, x1, y2, x2)]
-    anchors = utils.generate_pyramid_anchors(config.RPN_ANCHOR_SCALES,
-                                             config.RPN_ANCHOR_RATIOS,
-                                             config.BACKBONE_SHAPES,
-                                             config.BACKBONE_STRIDES,
-                                             config.RPN_ANCHOR_STRIDE)
+    if anchor_cache is None:
+        anchor_cache = utils.AnchorCache(max_size=config.ANCHOR_CACHE_SIZE,
+                                         cache_dir=config.ANCHOR_CACHE_DIR)
+    anchors = anchor_cache.get(config.RPN_ANCHOR_SCALES,
+                               config.RPN_ANCHOR_RATIOS,
+                               config.BACKBONE_SHAPES,
+                               config.BACKBONE_STRIDES,
+                               config.RPN_ANCHOR_STRIDE)
 
     # Keras requires a generator to run indefinately.
     while True:
@@ -1748,6 +1836,14 @@ def data_generator(dataset, config, shuffle=True, augment=True, random_rois=0,
 #  MaskRCNN Class
 ############################################################
 
+# Layers whose outputs are per class, with the number of values per class.
+# Their weights are sliced when the heads are built for a subset of the
+# classes (Config.INFERENCE_CLASS_IDS).
+CLASS_HEAD_LAYERS = OrderedDict([("mrcnn_class_logits", 1),
+                                 ("mrcnn_bbox_fc", 4),
+                                 ("mrcnn_mask", 1)])
+
+
 class MaskRCNN():
     """Encapsulates the Mask RCNN model functionality.
 
@@ -1765,8 +1861,28 @@ class MaskRCNN():
         self.config = config
         self.model_dir = model_dir
         self.set_log_dir()
+        self.init_caches()
+        # Classes the inference heads are built for, in the order of their
+        # outputs, or None for all classes. See Config.INFERENCE_CLASS_IDS.
+        self.head_class_ids = None
+        if mode == "inference" and config.INFERENCE_CLASS_IDS:
+            self.head_class_ids = np.array(
+                [0] + sorted(set(config.INFERENCE_CLASS_IDS) - {0}),
+                dtype=np.int32)
         self.keras_model = self.build(mode=mode, config=config)
 
+    def init_caches(self):
+        """Creates the per-model caches that build(), detect() and train()
+        reuse across calls. Requires self.config.
+        """
+        # Reused input buffers of detect()
+        self.buffer_pool = utils.BufferPool()
+        # Anchors by image size and anchor settings, shared with the
+        # data generators of train()
+        self.anchor_cache = utils.AnchorCache(
+            max_size=self.config.ANCHOR_CACHE_SIZE,
+            cache_dir=self.config.ANCHOR_CACHE_DIR)
+
     def build(self, mode, config):
         """Build Mask R-CNN architecture.
             input_shape: The shape of the input image.
@@ -1774,6 +1890,8 @@ class MaskRCNN():
                 outputs of the model differ accordingly.
         """
         assert mode in ['training', 'inference']
+        assert config.IMAGE_PADDING or mode == "inference", \
+            "IMAGE_PADDING=False is only supported for inference"
 
         # Image size must be dividable by 2 multiple times
         h, w = config.IMAGE_SHAPE[:2]
@@ -1783,8 +1901,17 @@ class MaskRCNN():
                             "For example, use 256, 320, 384, 448, 512, ... etc. ")
 
         # Inputs
-        input_image = KL.Input(
-            shape=config.IMAGE_SHAPE.tolist(), name="input_image")
+        # Without padding, images keep their aspect ratio and the input size
+        # changes from batch to batch, so the anchors for it are an input too.
+        if config.IMAGE_PADDING:
+            input_image = KL.Input(
+                shape=config.IMAGE_SHAPE.tolist(), name="input_image")
+            image_shape = config.IMAGE_SHAPE
+        else:
+            input_image = KL.Input(
+                shape=[None, None, config.IMAGE_SHAPE[2]], name="input_image")
+            input_anchors = KL.Input(shape=[None, 4], name="input_anchors")
+            image_shape = None
         input_image_meta = KL.Input(shape=[None], name="input_image_meta")
         if mode == "training":
             # RPN GT
@@ -1848,11 +1975,10 @@ class MaskRCNN():
         mrcnn_feature_maps = [P2, P3, P4, P5]
 
         # Generate Anchors
-        self.anchors = utils.generate_pyramid_anchors(config.RPN_ANCHOR_SCALES,
-                                                      config.RPN_ANCHOR_RATIOS,
-                                                      config.BACKBONE_SHAPES,
-                                                      config.BACKBONE_STRIDES,
-                                                      config.RPN_ANCHOR_STRIDE)
+        if config.IMAGE_PADDING:
+            self.anchors = self.get_anchors(config.IMAGE_SHAPE)
+        else:
+            self.anchors = None
 
         # RPN Model
         rpn = build_rpn_model(config.RPN_ANCHOR_STRIDE,
@@ -1881,7 +2007,9 @@ class MaskRCNN():
                                  nms_threshold=config.RPN_NMS_THRESHOLD,
                                  name="ROI",
                                  anchors=self.anchors,
-                                 config=config)([rpn_class, rpn_bbox])
+                                 config=config)(
+            [rpn_class, rpn_bbox] if config.IMAGE_PADDING else
+            [rpn_class, rpn_bbox, input_anchors, input_image])
 
         if mode == "training":
             # Class ID mask to mark class IDs supported by the dataset the image
@@ -1944,34 +2072,59 @@ class MaskRCNN():
                        rpn_class_loss, rpn_bbox_loss, class_loss, bbox_loss, mask_loss]
             model = KM.Model(inputs, outputs, name='mask_rcnn')
         else:
+            # Heads can be built for a subset of the classes
+            num_classes = config.NUM_CLASSES if self.head_class_ids is None \
+                else len(self.head_class_ids)
+
             # Network Heads
             # Proposal classifier and BBox regressor heads
             mrcnn_class_logits, mrcnn_class, mrcnn_bbox =\
-                fpn_classifier_graph(rpn_rois, mrcnn_feature_maps, config.IMAGE_SHAPE,
-                                     config.POOL_SIZE, config.NUM_CLASSES)
+                fpn_classifier_graph(rpn_rois, mrcnn_feature_maps, image_shape,
+                                     config.POOL_SIZE, num_classes,
+                                     input_image=input_image)
 
             # Detections
             # output is [batch, num_detections, (y1, x1, y2, x2, class_id, score)] in image coordinates
             detections = DetectionLayer(config, name="mrcnn_detection")(
-                [rpn_rois, mrcnn_class, mrcnn_bbox, input_image_meta])
+                [rpn_rois, mrcnn_class, mrcnn_bbox, input_image_meta] +
+                ([] if config.IMAGE_PADDING else [input_image]))
 
             # Convert boxes to normalized coordinates
             # TODO: let DetectionLayer return normalized coordinates to avoid
             #       unnecessary conversions
-            h, w = config.IMAGE_SHAPE[:2]
+            if config.IMAGE_PADDING:
+                h, w = config.IMAGE_SHAPE[:2]
+                image_scale = np.array([h, w, h, w])
+            else:
+                h, w = K.shape(input_image)[1], K.shape(input_image)[2]
+                image_scale = K.cast(K.stack([h, w, h, w], axis=0), tf.float32)
             detection_boxes = KL.Lambda(
-                lambda x: x[..., :4] / np.array([h, w, h, w]))(detections)
+                lambda x: x[..., :4] / image_scale)(detections)
 
             # Create masks for detections
             mrcnn_mask = build_fpn_mask_graph(detection_boxes, mrcnn_feature_maps,
-                                              config.IMAGE_SHAPE,
+                                              image_shape,
                                               config.MASK_POOL_SIZE,
-                                              config.NUM_CLASSES)
-
-            model = KM.Model([input_image, input_image_meta],
-                             [detections, mrcnn_class, mrcnn_bbox,
-                                 mrcnn_mask, rpn_rois, rpn_class, rpn_bbox],
-                             name='mask_rcnn')
+                                              num_classes,
+                                              input_image=input_image)
+            if config.DETECTION_MASK_GATHER:
+                mrcnn_mask = KL.Lambda(
+                    lambda x: gather_detection_masks_graph(
+                        *x, threshold=config.DETECTION_MASK_THRESHOLD),
+                    output_shape=lambda s: s[1][:4],
+                    name="mrcnn_detection_mask")([detections, mrcnn_mask])
+
+            if config.DETECTION_SLIM_OUTPUTS:
+                # Only what detect() needs. The other tensors are still in
+                # the graph and can be fetched with run_graph().
+                outputs = [detections, mrcnn_mask]
+            else:
+                outputs = [detections, mrcnn_class, mrcnn_bbox,
+                           mrcnn_mask, rpn_rois, rpn_class, rpn_bbox]
+            inputs = [input_image, input_image_meta]
+            if not config.IMAGE_PADDING:
+                inputs.append(input_anchors)
+            model = KM.Model(inputs, outputs, name='mask_rcnn')
 
         # Add multi-GPU support.
         if config.GPU_COUNT > 1:
@@ -2010,10 +2163,25 @@ class MaskRCNN():
         the addition of multi-GPU support and the ability to exclude
         some layers from loading.
         exlude: list of layer names to excluce
+
+        Files with the utils.FLAT_WEIGHTS_EXTENSION extension are loaded
+        with load_flat_weights() instead, always by name.
+
+        If the heads were built for a subset of the classes (see
+        Config.INFERENCE_CLASS_IDS), their final layers are sliced from
+        the full weights.
         """
+        if filepath.endswith(utils.FLAT_WEIGHTS_EXTENSION):
+            self.load_flat_weights(filepath, exclude)
+            self.set_log_dir(filepath)
+            return
+
         import h5py
         from keras.engine import topology
 
+        if self.head_class_ids is not None:
+            exclude = list(exclude or []) + list(CLASS_HEAD_LAYERS)
+
         if exclude:
             by_name = True
 
@@ -2037,12 +2205,70 @@ class MaskRCNN():
             topology.load_weights_from_hdf5_group_by_name(f, layers)
         else:
             topology.load_weights_from_hdf5_group(f, layers)
+        if self.head_class_ids is not None:
+            self.load_class_head_weights(OrderedDict(
+                (name, [f[name][n][()] for n in f[name].attrs['weight_names']])
+                for name in CLASS_HEAD_LAYERS if name in f))
         if hasattr(f, 'close'):
             f.close()
 
         # Update the log directory
         self.set_log_dir(filepath)
 
+    def load_flat_weights(self, filepath, exclude=None):
+        """Loads weights from a file written by utils.convert_weights_to_flat().
+        The file is memory-mapped and the weights of all layers are
+        assigned in one batch, matched by layer name. Layers that aren't
+        in the file are skipped.
+
+        exclude: list of layer names to exclude
+        """
+        weights = utils.load_flat_weights(filepath)
+        exclude = set(exclude or [])
+        if self.head_class_ids is not None:
+            exclude.update(CLASS_HEAD_LAYERS)
+
+        # In multi-GPU training, we wrap the model. Get layers
+        # of the inner model because they have the weights.
+        keras_model = self.keras_model
+        layers = keras_model.inner_model.layers if hasattr(keras_model, "inner_model")\
+            else keras_model.layers
+
+        weight_value_tuples = []
+        for layer in layers:
+            if layer.name in exclude or layer.name not in weights:
+                continue
+            values = weights[layer.name]
+            if len(values) != len(layer.weights):
+                raise ValueError(
+                    "Layer {} expects {} weights, but the file has {}".format(
+                        layer.name, len(layer.weights), len(values)))
+            weight_value_tuples += zip(layer.weights, values)
+        K.batch_set_value(weight_value_tuples)
+
+        if self.head_class_ids is not None:
+            self.load_class_head_weights(weights)
+
+    def load_class_head_weights(self, weights):
+        """Loads the final layers of the classifier, box and mask heads
+        for the classes in self.head_class_ids, slicing them from the
+        full weights.
+
+        weights: dict of layer name -> list of weight arrays of the full
+            model. Layers that aren't in it are skipped.
+        """
+        keras_model = self.keras_model
+        model = keras_model.inner_model if hasattr(keras_model, "inner_model")\
+            else keras_model
+        for name, width in CLASS_HEAD_LAYERS.items():
+            if name not in weights:
+                continue
+            # The class axis is the last one, with `width` values per class
+            columns = (self.head_class_ids[:, np.newaxis] * width +
+                       np.arange(width)).ravel()
+            model.get_layer(name).set_weights(
+                [w[..., columns] for w in weights[name]])
+
     def get_imagenet_weights(self):
         """Downloads ImageNet trained weights from Keras.
         Returns path to weights file.
@@ -2203,10 +2429,12 @@ class MaskRCNN():
 
         # Data generators
         train_generator = data_generator(train_dataset, self.config, shuffle=True,
-                                         batch_size=self.config.BATCH_SIZE)
+                                         batch_size=self.config.BATCH_SIZE,
+                                         anchor_cache=self.anchor_cache)
         val_generator = data_generator(val_dataset, self.config, shuffle=True,
                                        batch_size=self.config.BATCH_SIZE,
-                                       augment=False)
+                                       augment=False,
+                                       anchor_cache=self.anchor_cache)
 
         # Callbacks
         callbacks = [
@@ -2244,11 +2472,49 @@ class MaskRCNN():
         )
         self.epoch = max(self.epoch, epochs)
 
-    def mold_inputs(self, images):
+    def get_anchors(self, image_shape):
+        """Returns the anchors for input images of the given size.
+        image_shape: [height, width(, depth)] of the molded images.
+
+        Returns: [N, (y1, x1, y2, x2)] anchors in image coordinates, from
+        self.anchor_cache. The array is shared and read-only.
+        """
+        config = self.config
+        backbone_shapes = utils.compute_backbone_shapes(
+            image_shape, config.BACKBONE_STRIDES)
+        return self.anchor_cache.get(config.RPN_ANCHOR_SCALES,
+                                     config.RPN_ANCHOR_RATIOS,
+                                     backbone_shapes,
+                                     config.BACKBONE_STRIDES,
+                                     config.RPN_ANCHOR_STRIDE)
+
+    def model_inputs(self, molded_images, image_metas):
+        """Returns the list of inputs of the inference model for a batch of
+        molded images. Without IMAGE_PADDING, that includes the anchors for
+        the size of the batch.
+        """
+        inputs = [molded_images, image_metas]
+        if not self.config.IMAGE_PADDING:
+            anchors = self.get_anchors(molded_images.shape[1:3])
+            inputs.append(np.broadcast_to(
+                anchors, (molded_images.shape[0],) + anchors.shape))
+        return inputs
+
+    def mold_inputs(self, images, batch_size=None, buffer_pool=None):
         """Takes a list of images and modifies them to the format expected
         as an input to the neural network.
         images: List of image matricies [height,width,depth]. Images can have
             different sizes.
+        batch_size: Optional. Number of rows of molded_images and
+            image_metas, if more than len(images). The extra rows repeat
+            the last image, to fill a partial batch.
+        buffer_pool: Optional utils.BufferPool. If given, the returned
+            arrays are reused buffers from the pool, which the next call
+            with the same pool overwrites.
+
+        Images are resized with the Config.RESIZE_BACKEND function and
+        written straight into one preallocated float32 batch, where the
+        mean pixel is subtracted in place.
 
         Returns 3 Numpy matricies:
         molded_images: [N, h, w, 3]. Images resized and normalized.
@@ -2256,42 +2522,77 @@ class MaskRCNN():
         windows: [N, (y1, x1, y2, x2)]. The portion of the image that has the
             original image (padding excluded).
         """
-        molded_images = []
-        image_metas = []
-        windows = []
-        for image in images:
-            # Resize image to fit the model expected size
-            # TODO: move resizing to mold_image()
-            molded_image, window, scale, padding = utils.resize_image(
-                image,
-                min_dim=self.config.IMAGE_MIN_DIM,
-                max_dim=self.config.IMAGE_MAX_DIM,
-                padding=self.config.IMAGE_PADDING)
-            molded_image = mold_image(molded_image, self.config)
+        config = self.config
+        geometries = [utils.resize_geometry(
+            image.shape[0], image.shape[1],
+            min_dim=config.IMAGE_MIN_DIM,
+            max_dim=config.IMAGE_MAX_DIM,
+            padding=config.IMAGE_PADDING) for image in images]
+        if config.IMAGE_PADDING:
+            height, width = config.IMAGE_SHAPE[:2]
+        else:
+            # Images keep their aspect ratio. The batch fits the largest
+            # one, rounded up to a multiple of 64 so that the backbone can
+            # halve it 6 times, with the padding at the bottom and right.
+            height = max(window[2] for _, window, _, _ in geometries)
+            width = max(window[3] for _, window, _, _ in geometries)
+            height = int(math.ceil(height / 64.)) * 64
+            width = int(math.ceil(width / 64.)) * 64
+
+        batch_size = max(batch_size or 0, len(images))
+        meta_length = 8 + config.NUM_CLASSES
+        if buffer_pool is not None:
+            molded_images = buffer_pool.get(
+                "molded_images", [batch_size, height, width, 3], np.float32)
+            image_metas = buffer_pool.get(
+                "image_metas", [batch_size, meta_length], np.int64)
+            windows = buffer_pool.get("windows", [len(images), 4], np.int32)
+        else:
+            molded_images = np.empty([batch_size, height, width, 3],
+                                     dtype=np.float32)
+            image_metas = np.empty([batch_size, meta_length], dtype=np.int64)
+            windows = np.empty([len(images), 4], dtype=np.int32)
+        mean_pixel = config.MEAN_PIXEL.astype(np.float32)
+        for i, (image, (size, window, scale, _)) in enumerate(
+                zip(images, geometries)):
+            # Padding is 0 before mean subtraction, so -mean_pixel after
+            molded_images[i] = -mean_pixel
+            y1, x1, y2, x2 = window
+            molded_image = molded_images[i, y1:y2, x1:x2]
+            molded_image[...] = image if scale == 1 else \
+                utils.resize(image, size, config.RESIZE_BACKEND)
+            molded_image -= mean_pixel
             # Build image_meta
-            image_meta = compose_image_meta(
+            image_metas[i] = compose_image_meta(
                 0, image.shape, window,
-                np.zeros([self.config.NUM_CLASSES], dtype=np.int32))
-            # Append
-            molded_images.append(molded_image)
-            windows.append(window)
-            image_metas.append(image_meta)
-        # Pack into arrays
-        molded_images = np.stack(molded_images)
-        image_metas = np.stack(image_metas)
-        windows = np.stack(windows)
+                np.zeros([config.NUM_CLASSES], dtype=np.int32))
+            windows[i] = window
+        # Fill the rest of the batch with the last image
+        molded_images[len(images):] = molded_images[len(images) - 1]
+        image_metas[len(images):] = image_metas[len(images) - 1]
         return molded_images, image_metas, windows
 
-    def unmold_detections(self, detections, mrcnn_mask, image_shape, window):
+    def unmold_detections(self, detections, mrcnn_mask, image_shape, window,
+                          keep_class_ids=None, instance_filter=None,
+                          sparse_masks=False):
         """Reformats the detections of one image from the format of the neural
         network output to a format suitable for use in the rest of the
         application.
 
         detections: [N, (y1, x1, y2, x2, class_id, score)]
-        mrcnn_mask: [N, height, width, num_classes]
+        mrcnn_mask: [N, height, width, num_classes], or [N, height, width]
+            if the graph already picked each detection's class mask
+            (see Config.DETECTION_MASK_GATHER).
         image_shape: [height, width, depth] Original size of the image before resizing
         window: [y1, x1, y2, x2] Box in the image where the real image is
                 excluding the padding.
+        keep_class_ids: Optional list of class IDs. Detections of other
+            classes are dropped before their masks are resized.
+        instance_filter: Optional function (boxes, class_ids, scores) -> [N]
+            bool array, called with the image-domain detections. Only
+            instances for which it returns True are kept.
+        sparse_masks: If True, return masks as a utils.InstanceMasks
+            (boxes plus cropped masks) instead of a dense array.
 
         Returns:
         boxes: [N, (y1, x1, y2, x2)] Bounding boxes in pixels
@@ -2308,7 +2609,13 @@ class MaskRCNN():
         boxes = detections[:N, :4]
         class_ids = detections[:N, 4].astype(np.int32)
         scores = detections[:N, 5]
-        masks = mrcnn_mask[np.arange(N), :, :, class_ids]
+        if mrcnn_mask.ndim == 3:
+            masks = mrcnn_mask[:N]
+        else:
+            masks = mrcnn_mask[np.arange(N), :, :, class_ids]
+        # Map class IDs of class-pruned heads back to the full class IDs
+        if self.head_class_ids is not None:
+            class_ids = self.head_class_ids[class_ids]
 
         # Compute scale and shift to translate coordinates to image domain.
         h_scale = image_shape[0] / (window[2] - window[0])
@@ -2332,59 +2639,148 @@ class MaskRCNN():
             masks = np.delete(masks, exclude_ix, axis=0)
             N = class_ids.shape[0]
 
+        # Drop unwanted instances now, so that only the masks that are
+        # actually needed are resized to full image size.
+        keep = np.ones([N], dtype=bool)
+        if keep_class_ids is not None:
+            keep &= np.in1d(class_ids, keep_class_ids)
+        if instance_filter is not None:
+            keep &= np.asarray(instance_filter(boxes, class_ids, scores),
+                               dtype=bool)
+        if not np.all(keep):
+            boxes = boxes[keep]
+            class_ids = class_ids[keep]
+            scores = scores[keep]
+            masks = masks[keep]
+            N = class_ids.shape[0]
+
         # Resize masks to original image size and set boundary threshold.
-        full_masks = []
-        for i in range(N):
-            # Convert neural network mask to full size mask
-            full_mask = utils.unmold_mask(masks[i], boxes[i], image_shape)
-            full_masks.append(full_mask)
-        full_masks = np.stack(full_masks, axis=-1)\
-            if full_masks else np.empty((0,) + masks.shape[1:3])
+        full_masks = utils.unmold_masks(masks, boxes, image_shape,
+                                        sparse=sparse_masks)
 
         return boxes, class_ids, scores, full_masks
 
-    def detect(self, images, verbose=0):
+    def detect(self, images, verbose=0, keep_class_ids=None,
+               instance_filter=None, sparse_masks=False, profiler=None):
         """Runs the detection pipeline.
 
-        images: List of images, potentially of different sizes.
+        images: List of images, potentially of different sizes. Up to
+            BATCH_SIZE images. Partial batches are padded internally and
+            the padding is discarded from the results.
+        keep_class_ids, instance_filter: Optional. Only return the selected
+            detections. See unmold_detections(). Unselected instances skip
+            the costly resizing of their masks to full image size.
+        sparse_masks: If True, masks are returned as utils.InstanceMasks,
+            which store each instance as its box and a cropped mask.
+        profiler: Optional profiling.Profiler. Times the mold_inputs,
+            predict and unmold_detections stages and counts images,
+            returned instances and time spent allocating input buffers.
+
+        The input batch is molded into buffers kept in self.buffer_pool,
+        which are reused as long as the input size stays the same.
 
         Returns a list of dicts, one dict per image. The dict contains:
         rois: [N, (y1, x1, y2, x2)] detection bounding boxes
         class_ids: [N] int class IDs
         scores: [N] float probability scores for the class IDs
-        masks: [H, W, N] instance binary masks
+        masks: [H, W, N] instance binary masks (or utils.InstanceMasks)
         """
         assert self.mode == "inference", "Create model in inference mode."
-        assert len(
-            images) == self.config.BATCH_SIZE, "len(images) must be equal to BATCH_SIZE"
+        assert 0 < len(images) <= self.config.BATCH_SIZE,\
+            "len(images) must be between 1 and BATCH_SIZE"
+        profiler = profiler or profiling.NULL_PROFILER
 
         if verbose:
             log("Processing {} images".format(len(images)))
             for image in images:
                 log("image", image)
         # Mold inputs to format expected by the neural network
-        molded_images, image_metas, windows = self.mold_inputs(images)
+        # The graph is unrolled over BATCH_SIZE, so a partial batch is
+        # filled by repeating the last image. Only the first len(images)
+        # results are unmolded below.
+        allocation_seconds = self.buffer_pool.allocation_seconds
+        with profiler.stage("mold_inputs"):
+            molded_images, image_metas, windows = self.mold_inputs(
+                images, batch_size=self.config.BATCH_SIZE,
+                buffer_pool=self.buffer_pool)
+        profiler.count("buffer_allocation_ms", 1000. * (
+            self.buffer_pool.allocation_seconds - allocation_seconds))
         if verbose:
             log("molded_images", molded_images)
             log("image_metas", image_metas)
         # Run object detection
-        detections, mrcnn_class, mrcnn_bbox, mrcnn_mask, \
-            rois, rpn_class, rpn_bbox =\
-            self.keras_model.predict([molded_images, image_metas], verbose=0)
+        with profiler.stage("predict"):
+            detections, mrcnn_mask = self.predict(molded_images, image_metas)
         # Process detections
         results = []
-        for i, image in enumerate(images):
-            final_rois, final_class_ids, final_scores, final_masks =\
-                self.unmold_detections(detections[i], mrcnn_mask[i],
-                                       image.shape, windows[i])
-            results.append({
-                "rois": final_rois,
-                "class_ids": final_class_ids,
-                "scores": final_scores,
-                "masks": final_masks,
-            })
+        with profiler.stage("unmold_detections"):
+            for i, image in enumerate(images):
+                final_rois, final_class_ids, final_scores, final_masks =\
+                    self.unmold_detections(detections[i], mrcnn_mask[i],
+                                           image.shape, windows[i],
+                                           keep_class_ids, instance_filter,
+                                           sparse_masks)
+                results.append({
+                    "rois": final_rois,
+                    "class_ids": final_class_ids,
+                    "scores": final_scores,
+                    "masks": final_masks,
+                })
+        profiler.count("images", len(images))
+        profiler.count("instances", sum(len(r["class_ids"]) for r in results))
         return results
 
+    def predict(self, molded_images, image_metas):
+        """Runs the inference model on a full batch of molded images.
+
+        Returns:
+        detections: [batch, num_detections, (y1, x1, y2, x2, class_id, score)]
+        mrcnn_mask: [batch, num_detections, height, width(, num_classes)]
+        """
+        outputs = self.keras_model.predict(
+            self.model_inputs(molded_images, image_metas), verbose=0)
+        if self.config.DETECTION_SLIM_OUTPUTS:
+            detections, mrcnn_mask = outputs
+        else:
+            detections, mrcnn_class, mrcnn_bbox, mrcnn_mask, \
+                rois, rpn_class, rpn_bbox = outputs
+        return detections, mrcnn_mask
+
+    def export_frozen_graph(self, filepath):
+        """Writes the inference graph with the current weights baked in as
+        constants to a TensorFlow GraphDef file, which FrozenMaskRCNN loads
+        without building the model in Keras. The tensor names and the
+        settings the graph was built with are saved next to it, in
+        filepath + ".json".
+        """
+        assert self.mode == "inference", "Create model in inference mode."
+        keras_model = self.keras_model
+        detections = keras_model.outputs[0]
+        mrcnn_mask = keras_model.outputs[
+            1 if self.config.DETECTION_SLIM_OUTPUTS else 3]
+
+        session = K.get_session()
+        graph_def = tf.graph_util.convert_variables_to_constants(
+            session, session.graph.as_graph_def(),
+            [detections.op.name, mrcnn_mask.op.name])
+        with open(filepath, 'wb') as f:
+            f.write(graph_def.SerializeToString())
+
+        metadata = {
+            "inputs": [t.name for t in keras_model.inputs],
+            "outputs": [detections.name, mrcnn_mask.name],
+            "learning_phase": K.learning_phase().name
+            if keras_model.uses_learning_phase and
+            not isinstance(K.learning_phase(), int) else None,
+            "batch_size": self.config.BATCH_SIZE,
+            "image_shape": [int(x) for x in self.config.IMAGE_SHAPE],
+            "image_padding": bool(self.config.IMAGE_PADDING),
+            "head_class_ids": None if self.head_class_ids is None
+            else self.head_class_ids.tolist(),
+        }
+        with open(filepath + ".json", 'w') as f:
+            json.dump(metadata, f, indent=2)
+
     def ancestor(self, tensor, name, checked=None):
         """Finds the ancestor of a TF tensor in the computation graph.
         tensor: TensorFlow symbolic tensor.
@@ -2471,7 +2867,7 @@ class MaskRCNN():
         #     outputs_np = kf(model_in)
         # else:
 
-        model_in = [molded_images, image_metas]
+        model_in = self.model_inputs(molded_images, image_metas)
         if model.uses_learning_phase and not isinstance(K.learning_phase(), int):
             model_in.append(0.)
         outputs_np = kf(model_in)
@@ -2484,6 +2880,69 @@ class MaskRCNN():
         return outputs_np
 
 
+class FrozenMaskRCNN(MaskRCNN):
+    """Inference-only Mask R-CNN that runs a graph written by
+    MaskRCNN.export_frozen_graph() instead of building the model in Keras.
+    detect() works the same as in MaskRCNN.
+
+    The config must match the one the graph was exported with in
+    everything that affects the inputs and outputs (image size, batch
+    size, class pruning).
+    """
+
+    def __init__(self, filepath, config):
+        """
+        filepath: path of the exported GraphDef file
+        config: A Sub-class of the Config class
+        """
+        with open(filepath + ".json") as f:
+            metadata = json.load(f)
+        assert metadata["batch_size"] == config.BATCH_SIZE, \
+            "The graph was exported with BATCH_SIZE {}".format(
+                metadata["batch_size"])
+        assert metadata["image_shape"] == [int(x) for x in config.IMAGE_SHAPE], \
+            "The graph was exported with IMAGE_SHAPE {}".format(
+                metadata["image_shape"])
+        assert metadata.get("image_padding", True) == config.IMAGE_PADDING, \
+            "The graph was exported with IMAGE_PADDING {}".format(
+                metadata.get("image_padding", True))
+
+        self.mode = "inference"
+        self.config = config
+        self.init_caches()
+        self.head_class_ids = None if metadata["head_class_ids"] is None \
+            else np.array(metadata["head_class_ids"], dtype=np.int32)
+
+        graph_def = tf.GraphDef()
+        with open(filepath, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+        self.session = tf.Session(graph=self.graph)
+
+        self.inputs = [self.graph.get_tensor_by_name(name)
+                       for name in metadata["inputs"]]
+        self.outputs = [self.graph.get_tensor_by_name(name)
+                        for name in metadata["outputs"]]
+        # The learning phase is only kept if the outputs depend on it
+        self.learning_phase = None
+        if metadata["learning_phase"]:
+            try:
+                self.learning_phase = self.graph.get_tensor_by_name(
+                    metadata["learning_phase"])
+            except KeyError:
+                pass
+
+    def predict(self, molded_images, image_metas):
+        feed_dict = dict(zip(self.inputs,
+                             self.model_inputs(molded_images, image_metas)))
+        if self.learning_phase is not None:
+            feed_dict[self.learning_phase] = False
+        detections, mrcnn_mask = self.session.run(self.outputs, feed_dict)
+        return detections, mrcnn_mask
+
+
 ############################################################
 #  Data Formatting
 ############################################################
@@ -2526,7 +2985,7 @@ def mold_image(images, config):
     the mean pixel and converts it to float. Expects image
     colors in RGB order.
     """
-    return images.astype(np.float32) - config.MEAN_PIXEL
+    return images.astype(np.float32) - config.MEAN_PIXEL.astype(np.float32)
 
 
 def unmold_image(normalized_images, config):
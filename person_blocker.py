@@ -1,28 +1,52 @@
 import os
 import sys
+import glob
+import time
 import argparse
 import numpy as np
-import coco
-import utils
-import model as modellib
-from classes import get_class_names, InferenceConfig
+from collections import OrderedDict
+from classes import get_class_names, InferenceConfig, INFERENCE_PRESETS
+from profiling import make_profiler, NULL_PROFILER
 from ast import literal_eval as make_tuple
 import imageio
-import visualize
 
-# Creates a color layer and adds Gaussian noise.
-# For each pixel, the same noise value is added to each channel
-# to mitigate hue shfting.
+# TensorFlow, Keras and matplotlib take seconds to import, so model,
+# utils, visualize and the modules that depend on them are imported in
+# the functions that need them. --help and --names don't load them at
+# all (see benchmarks/bench_import.py).
 
+# A few precomputed noise tiles that are reused for every frame and
+# image. Each frame picks a tile and a random shift and gathers the
+# noise for the blocked pixels from it (wrapping around the tile),
+# which is much cheaper than drawing new random numbers for every
+# pixel. The same noise value is added to each channel of a pixel to
+# mitigate hue shifting. Tiles are colored and cached per block color.
+# A fixed seed makes the output deterministic.
 
-def create_noisy_color(image, color):
-    color_mask = np.full(shape=(image.shape[0], image.shape[1], 3),
-                         fill_value=color)
+class NoiseBank(object):
 
-    noise = np.random.normal(0, 25, (image.shape[0], image.shape[1]))
-    noise = np.repeat(np.expand_dims(noise, axis=2), repeats=3, axis=2)
-    mask_noise = np.clip(color_mask + noise, 0., 255.)
-    return mask_noise
+    def __init__(self, num_tiles=4, tile_size=256, seed=None):
+        self.random = np.random.RandomState(seed)
+        self.tile_size = tile_size
+        self.noise = self.random.normal(
+            0, 25, (num_tiles, tile_size, tile_size, 1)).astype(np.float32)
+        self.colored_tiles = {}
+
+    def get_tiles(self, color):
+        color = tuple(color)
+        if color not in self.colored_tiles:
+            tiles = np.clip(self.noise + np.asarray(color, dtype=np.float32),
+                            0., 255.)
+            self.colored_tiles[color] = tiles.astype(np.uint8)
+        return self.colored_tiles[color]
+
+    # Returns [N, 3] uint8 noisy color values for the pixels at (ys, xs)
+
+    def sample(self, ys, xs, color):
+        tiles = self.get_tiles(color)
+        tile = tiles[self.random.randint(tiles.shape[0])]
+        dy, dx = self.random.randint(self.tile_size, size=2)
+        return tile[(ys + dy) % self.tile_size, (xs + dx) % self.tile_size]
 
 
 # Helper function to allow both RGB triplet + hex CL input
@@ -44,73 +68,553 @@ def string_to_rgb_triplet(triplet):
         return triplet
 
 
-def person_blocker(args):
+# Collects the image paths for batch mode. The source can be a
+# directory, a glob pattern or a manifest file with one path per line.
 
-    # Required to load model, but otherwise unused
-    ROOT_DIR = os.getcwd()
-    COCO_MODEL_PATH = args.model or os.path.join(ROOT_DIR, "mask_rcnn_coco.h5")
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.gif')
 
-    MODEL_DIR = os.path.join(ROOT_DIR, "logs")  # Required to load model
+
+def collect_images(source):
+
+    if os.path.isdir(source):
+        return sorted(os.path.join(source, f) for f in os.listdir(source)
+                      if f.lower().endswith(IMAGE_EXTENSIONS))
+
+    if os.path.isfile(source) and not source.lower().endswith(
+            IMAGE_EXTENSIONS):
+        base_dir = os.path.dirname(source)
+        with open(source) as f:
+            paths = [line.strip() for line in f]
+        return [os.path.join(base_dir, p) for p in paths
+                if p and not p.startswith('#')]
+
+    return sorted(glob.glob(source))
+
+
+# Output prefixes for batch mode, name_blocked for an input name.jpg.
+# Inputs whose names would collide (the same name in different
+# directories, or with a different extension) are named by their path
+# relative to the common directory of all inputs instead, e.g.
+# a_img_jpg_blocked, and any that still collide get a numeric suffix.
+
+def output_prefixes(image_paths, output_dir):
+
+    names = [os.path.splitext(os.path.basename(p))[0] for p in image_paths]
+    if len(set(names)) < len(names):
+        common_dir = os.path.commonpath(
+            [os.path.dirname(os.path.abspath(p)) for p in image_paths])
+        counts = {}
+        for name in names:
+            counts[name] = counts.get(name, 0) + 1
+        names = [os.path.relpath(os.path.abspath(p), common_dir)
+                 .replace(os.sep, '_').replace('.', '_')
+                 if counts[name] > 1 else name
+                 for p, name in zip(image_paths, names)]
+
+    prefixes = []
+    used = set()
+    for name in names:
+        prefix, suffix = name, 1
+        while prefix in used:
+            suffix += 1
+            prefix = '{}_{}'.format(name, suffix)
+        used.add(prefix)
+        prefixes.append(os.path.join(output_dir, prefix + '_blocked'))
+    return prefixes
+
+
+# Exported frozen graphs (see export_graph()) are recognized by this
+# extension and loaded without building the model.
+
+FROZEN_GRAPH_EXTENSION = '.pb'
+
+
+# Path of the COCO weights, downloading them if necessary. Flat weights
+# files (see convert_weights()) and frozen graphs can't be downloaded.
+
+def coco_model_path(model_path=None):
+
+    import utils
+
+    COCO_MODEL_PATH = model_path or \
+        os.path.join(os.getcwd(), "mask_rcnn_coco.h5")
 
     if not os.path.exists(COCO_MODEL_PATH):
+        if COCO_MODEL_PATH.endswith(utils.FLAT_WEIGHTS_EXTENSION):
+            sys.exit('{} not found. Create it with --convert-weights.'.format(
+                COCO_MODEL_PATH))
+        if COCO_MODEL_PATH.endswith(FROZEN_GRAPH_EXTENSION):
+            sys.exit('{} not found. Create it with --export-graph.'.format(
+                COCO_MODEL_PATH))
         utils.download_trained_weights(COCO_MODEL_PATH)
+    return COCO_MODEL_PATH
+
+
+# class_ids optionally restricts the model to those classes, see
+# Config.INFERENCE_CLASS_IDS.
+
+def load_model(model_path=None, batch_size=1, class_ids=None, preset=None,
+               overrides=None):
+
+    import model as modellib
+
+    # Required to load model, but otherwise unused
+    ROOT_DIR = os.getcwd()
+    COCO_MODEL_PATH = coco_model_path(model_path)
+
+    MODEL_DIR = os.path.join(ROOT_DIR, "logs")  # Required to load model
 
     # Load model and config
-    config = InferenceConfig()
+    config = InferenceConfig(images_per_gpu=batch_size, class_ids=class_ids,
+                             preset=preset, overrides=overrides)
+    if COCO_MODEL_PATH.endswith(FROZEN_GRAPH_EXTENSION):
+        return modellib.FrozenMaskRCNN(COCO_MODEL_PATH, config)
     model = modellib.MaskRCNN(mode="inference",
                               model_dir=MODEL_DIR, config=config)
     model.load_weights(COCO_MODEL_PATH, by_name=True)
+    return model
+
+
+# One-time conversion of the HDF5 weights to the flat format, which
+# loads faster and is memory-mapped rather than read into memory.
+
+def convert_weights(model_path, output_path):
+
+    import utils
+
+    if not output_path.endswith(utils.FLAT_WEIGHTS_EXTENSION):
+        output_path += utils.FLAT_WEIGHTS_EXTENSION
+    utils.convert_weights_to_flat(coco_model_path(model_path), output_path)
+    print('Wrote {}'.format(output_path))
+
+
+# Exports the model, with its weights, as a frozen TensorFlow graph that
+# load_model() can load without building the model. The graph is fixed
+# to the batch size and classes it was exported with.
+
+def export_graph(args):
+
+    output_path = args.export_graph
+    if not output_path.endswith(FROZEN_GRAPH_EXTENSION):
+        output_path += FROZEN_GRAPH_EXTENSION
+    model = load_model(args.model, batch_size=args.batch_size,
+                       class_ids=model_class_ids(args),
+                       preset=args.preset,
+                       overrides=config_overrides(args))
+    model.export_frozen_graph(output_path)
+    print('Wrote {}'.format(output_path))
+
+
+# Class IDs of the selected types of objects, or None if objects
+# are given as object IDs
+
+def selected_class_ids(objects):
+
+    objects = np.array(objects)
+    if np.all(np.chararray.isnumeric(objects)):
+        return None
+    return np.flatnonzero(np.in1d(get_class_names(), objects))
+
+
+# Classes to build the model for: only the selected ones with
+# --prune-classes, otherwise all of them
+
+def model_class_ids(args):
+
+    return selected_class_ids(args.objects) if args.prune_classes else None
+
+
+# Config settings of the individual tuning flags, which take precedence
+# over --preset
+
+CONFIG_FLAGS = OrderedDict([
+    ('min_dim', 'IMAGE_MIN_DIM'),
+    ('max_dim', 'IMAGE_MAX_DIM'),
+    ('padding', 'IMAGE_PADDING'),
+    ('pre_nms_limit', 'PRE_NMS_LIMIT'),
+    ('post_nms_rois', 'POST_NMS_ROIS_INFERENCE'),
+    ('max_instances', 'DETECTION_MAX_INSTANCES'),
+    ('backbone', 'BACKBONE'),
+])
+
+
+def config_overrides(args):
+
+    return {setting: getattr(args, flag)
+            for flag, setting in CONFIG_FLAGS.items()
+            if getattr(args, flag) is not None}
+
+
+# Filter masks to only the selected objects
+
+def select_objects(r, objects):
+
+    import utils
+
+    class_ids = selected_class_ids(objects)
+
+    # Types of objects:
+    if class_ids is not None:
+        object_indices = np.flatnonzero(np.in1d(r['class_ids'], class_ids))
+    # Track IDs (video mode):
+    elif 'track_ids' in r:
+        object_indices = np.flatnonzero(
+            np.in1d(r['track_ids'], np.array(objects).astype(int)))
+    # Object IDs:
+    else:
+        object_indices = np.array(objects).astype(int)
+
+    return utils.union_masks(r['masks'][:, :, object_indices])
+
 
-    image = imageio.imread(args.image)
+# Replace object masks with noise. The noise will be random for each
+# frame, which creates a "static" effect when the frames are animated.
+#
+# Only the bounding box of the mask changes between frames, so the
+# blocked crops of that box are returned on their own, along with the
+# box (y1, x1, y2, x2) and the mask cropped to it. The box is None if
+# nothing is blocked. Noise comes from noise_bank, or a new unseeded
+# NoiseBank if none is given.
 
-    # Create masks for all objects
-    results = model.detect([image], verbose=0)
-    r = results[0]
+def block_regions(image, mask_selected, mask_color, num_images=10,
+                  noise_bank=None):
 
+    mask = mask_selected > 0
+    rows = np.flatnonzero(np.any(mask, axis=1))
+    cols = np.flatnonzero(np.any(mask, axis=0))
+    if not rows.shape[0]:
+        return None, None, []
+    y1, y2, x1, x2 = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+    box_mask = mask[y1:y2, x1:x2]
+
+    # Generate noise only for the pixels under the mask
+    if noise_bank is None:
+        noise_bank = NoiseBank()
+    ys, xs = np.nonzero(box_mask)
+
+    regions = []
+    for _ in range(num_images):
+        region = image[y1:y2, x1:x2].copy()
+        region[box_mask] = noise_bank.sample(ys, xs, mask_color)
+        regions.append(region)
+    return (y1, x1, y2, x2), box_mask, regions
+
+
+# Returns a copy of image with a blocked region pasted into its box
+
+def paste_region(image, box, region):
+
+    new_image = image.copy()
+    if box is not None:
+        y1, x1, y2, x2 = box
+        new_image[y1:y2, x1:x2] = region
+    return new_image
+
+
+def block_frames(image, mask_selected, mask_color, num_images=10,
+                 noise_bank=None):
+
+    box, _, regions = block_regions(image, mask_selected, mask_color,
+                                    num_images, noise_bank)
+    if box is None:
+        return [image.copy() for _ in range(num_images)]
+    return [paste_region(image, box, region) for region in regions]
+
+
+# Encodes an animated GIF where the first frame is the full blocked image
+# and every following frame only covers the box of the blocked region.
+# All frames share one palette, quantized once from the first frame.
+# Pixels outside the mask are left transparent in the following frames,
+# so the unchanged background is neither re-quantized nor re-encoded.
+
+def encode_blocked_gif(first_frame, box, box_mask, regions, fps=30.):
+
+    from PIL import Image, GifImagePlugin
+
+    duration = int(round(1000. / fps))
+
+    # Reserve the last palette index for transparency
+    transparent = 255
+    quantized = Image.fromarray(first_frame).quantize(colors=transparent)
+    palette = Image.new('P', (1, 1))
+    palette.putpalette(quantized.getpalette()[:3 * transparent])
+    first = Image.fromarray(first_frame).quantize(palette=palette, dither=0)
+
+    header, _ = GifImagePlugin.getheader(first, info={'loop': 0})
+    chunks = header + GifImagePlugin.getdata(first, duration=duration)
+
+    if box is not None:
+        y1, x1 = box[:2]
+        for region in regions:
+            indices = np.array(Image.fromarray(region).quantize(
+                palette=palette, dither=0))
+            indices[~box_mask] = transparent
+            chunks += GifImagePlugin.getdata(
+                Image.frombytes('P', (indices.shape[1], indices.shape[0]),
+                                indices.tobytes()),
+                offset=(int(x1), int(y1)), duration=duration,
+                transparency=transparent, disposal=1)
+
+    chunks.append(b';')  # GIF trailer
+    return b''.join(chunks)
+
+
+def block_image(image, r, args, output_prefix='person_blocked',
+                noise_bank=None, profiler=None):
+
+    profiler = profiler or NULL_PROFILER
     if args.labeled:
+        import visualize
         position_ids = ['[{}]'.format(x)
                         for x in range(r['class_ids'].shape[0])]
         visualize.display_instances(image, r['rois'],
                                     r['masks'], r['class_ids'],
                                     get_class_names(), position_ids)
-        sys.exit()
+        return
 
-    # Filter masks to only the selected objects
-    objects = np.array(args.objects)
+    with profiler.stage('select_objects'):
+        mask_selected = select_objects(r, args.objects)
+    profiler.count('pixels_masked', int(np.count_nonzero(mask_selected)))
+    mask_color = string_to_rgb_triplet(args.color)
 
-    # Object IDs:
-    if np.all(np.chararray.isnumeric(objects)):
-        object_indices = objects.astype(int)
-    # Types of objects:
-    else:
-        selected_class_ids = np.flatnonzero(np.in1d(get_class_names(),
-                                                    objects))
-        object_indices = np.flatnonzero(
-            np.in1d(r['class_ids'], selected_class_ids))
+    # num_images should be a divisor of 30
+    with profiler.stage('block_regions'):
+        box, box_mask, regions = block_regions(image, mask_selected,
+                                               mask_color, num_images=10,
+                                               noise_bank=noise_bank)
+        image_masked = paste_region(image, box,
+                                    regions[0] if regions else None)
+
+    with profiler.stage('png_write'):
+        imageio.imwrite(output_prefix + '.png', image_masked)
+
+    # Create GIF
+    with profiler.stage('gif_encode'):
+        with open(output_prefix + '.gif', 'wb') as f:
+            f.write(encode_blocked_gif(image_masked, box, box_mask,
+                                       regions[1:], fps=30.))
+
+
+def person_blocker(args, profiler=None):
+
+    profiler = profiler or NULL_PROFILER
+    with profiler.setup('load_model'):
+        model = load_model(args.model, class_ids=model_class_ids(args),
+                           preset=args.preset,
+                           overrides=config_overrides(args))
+    with profiler.stage('imread'):
+        image = imageio.imread(args.image)
+
+    # Create masks for the selected types of objects, or for all objects
+    # if they're selected by ID
+    keep_class_ids = None if args.labeled else \
+        selected_class_ids(args.objects)
+    r = model.detect([image], verbose=0, keep_class_ids=keep_class_ids,
+                     sparse_masks=True, profiler=profiler)[0]
+    block_image(image, r, args, noise_bank=NoiseBank(seed=args.seed),
+                profiler=profiler)
+    profiler.end_record(image=args.image)
 
-    mask_selected = np.sum(r['masks'][:, :, object_indices], axis=2)
 
-    # Replace object masks with noise
+# Batch mode: the model is built and its weights are loaded once,
+# then reused for every input image. Images are run through the
+# network batch_size at a time; the last, partial batch is padded
+# by detect().
+
+def person_blocker_batch(args, profiler=None):
+
+    profiler = profiler or NULL_PROFILER
+    image_paths = collect_images(args.batch)
+    if not image_paths:
+        sys.exit('No images found for {}'.format(args.batch))
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    with profiler.setup('load_model'):
+        model = load_model(args.model, batch_size=args.batch_size,
+                           class_ids=model_class_ids(args),
+                           preset=args.preset,
+                           overrides=config_overrides(args))
+    noise_bank = NoiseBank(seed=args.seed)
+
+    prefixes = output_prefixes(image_paths, args.output_dir)
+
+    # Images that can't be read are reported and skipped. Profiler
+    # records cover one batch each.
+    skipped = []
+    for start in range(0, len(image_paths), args.batch_size):
+        batch = []
+        with profiler.stage('imread'):
+            for index in range(start, min(start + args.batch_size,
+                                          len(image_paths))):
+                image_path = image_paths[index]
+                try:
+                    image = imageio.imread(image_path)
+                except (OSError, ValueError) as e:
+                    print('Skipping {}: {}'.format(image_path, e),
+                          file=sys.stderr)
+                    skipped.append(image_path)
+                    continue
+                batch.append((index, image))
+        if not batch:
+            continue
+        results = model.detect([image for _, image in batch], verbose=0,
+                               keep_class_ids=selected_class_ids(args.objects),
+                               sparse_masks=True, profiler=profiler)
+
+        for (index, image), r in zip(batch, results):
+            print('[{}/{}] {}'.format(index + 1, len(image_paths),
+                                      image_paths[index]))
+            block_image(image, r, args, prefixes[index], noise_bank,
+                        profiler)
+        profiler.end_record(images=[image_paths[index]
+                                    for index, _ in batch])
+
+    if skipped:
+        print('Skipped {} unreadable image(s)'.format(len(skipped)),
+              file=sys.stderr)
+
+
+# Cheap scene-change metric for video mode: the mean absolute difference
+# between downsampled grayscale thumbnails of two frames (0-255 scale).
+
+def frame_signature(frame):
+    return frame[::16, ::16].mean(axis=2, dtype=np.float32)
+
+
+def scene_changed(signature, last_signature, threshold):
+    return bool(threshold) and \
+        np.mean(np.abs(signature - last_signature)) > threshold
+
+
+# Video mode: frames are decoded, blocked and encoded a few at a time,
+# so the whole clip is never held in memory.
+#
+# Detections are tracked across frames, so numeric --objects refer to
+# stable track IDs rather than per-frame positions. The tracks found are
+# listed at the end of the run.
+#
+# The network only runs on keyframes: every keyframe_interval frames, or
+# earlier when the scene changes by more than scene_threshold. Frames in
+# between reuse the mask of the previous keyframe, optionally dilated by
+# mask_dilation pixels to cover people moving in the meantime.
+# keyframe_interval=1 runs detection on every frame.
+
+def person_blocker_video(args, profiler=None):
+
+    import scipy.ndimage
+    from tracker import IoUTracker
+
+    profiler = profiler or NULL_PROFILER
+    with profiler.setup('load_model'):
+        model = load_model(args.model, batch_size=args.batch_size,
+                           class_ids=model_class_ids(args),
+                           preset=args.preset,
+                           overrides=config_overrides(args))
     mask_color = string_to_rgb_triplet(args.color)
-    image_masked = image.copy()
-    noisy_color = create_noisy_color(image, mask_color)
-    image_masked[mask_selected > 0] = noisy_color[mask_selected > 0]
+    noise_bank = NoiseBank(seed=args.seed)
 
-    imageio.imwrite('person_blocked.png', image_masked)
+    reader = imageio.get_reader(args.video)
+    fps = reader.get_meta_data().get('fps', 30.)
+    output = args.video_output or \
+        'person_blocked' + os.path.splitext(args.video)[1]
+    writer = imageio.get_writer(output, fps=fps)
 
-    # Create GIF. The noise will be random for each frame,
-    # which creates a "static" effect
+    last_mask = None
+    tracker = IoUTracker(iou_threshold=args.track_iou)
+    class_ids = selected_class_ids(args.objects)
+    track_ids = []
 
-    images = [image_masked]
-    num_images = 10   # should be a divisor of 30
+    # Tracks all detections, but keeps only the selected objects, so
+    # that masks are only resized for those.
+    def track_objects(boxes, detected_class_ids, scores):
+        ids = tracker.update(boxes, detected_class_ids)
+        if class_ids is not None:
+            keep = np.in1d(detected_class_ids, class_ids)
+        else:
+            keep = np.in1d(ids, np.array(args.objects).astype(int))
+        track_ids.append(ids[keep])
+        return keep
 
-    for _ in range(num_images - 1):
-        new_image = image.copy()
-        noisy_color = create_noisy_color(image, mask_color)
-        new_image[mask_selected > 0] = noisy_color[mask_selected > 0]
-        images.append(new_image)
+    # Keyframes are detected in batches of up to batch_size, as soon as a
+    # batch is full, or earlier when the next frame isn't a keyframe and
+    # needs the newest mask. So at most batch_size frames are held, and
+    # frames between keyframes are written right away with the last mask.
+    # Profiler records cover one forward pass each, along with the frames
+    # written since the previous one.
+    start = time.time()
+    num_frames = num_keyframes = record_frames = 0
 
-    imageio.mimsave('person_blocked.gif', images, fps=30., subrectangles=True)
+    def write_frame(frame):
+        nonlocal num_frames, record_frames
+        profiler.count('pixels_masked', int(np.count_nonzero(last_mask)))
+        with profiler.stage('block_frames'):
+            blocked = block_frames(frame, last_mask, mask_color, 1,
+                                   noise_bank)[0]
+        with profiler.stage('encode'):
+            writer.append_data(blocked)
+        num_frames += 1
+        record_frames += 1
+
+    def process(keyframes):
+        nonlocal last_mask, record_frames
+        del track_ids[:]
+        results = model.detect(keyframes, verbose=0,
+                               instance_filter=track_objects,
+                               sparse_masks=True, profiler=profiler)
+        for frame, r, ids in zip(keyframes, results, track_ids):
+            r['track_ids'] = ids
+            with profiler.stage('select_objects'):
+                mask_selected = select_objects(r, args.objects) > 0
+            if args.mask_dilation:
+                with profiler.stage('mask_dilation'):
+                    mask_selected = scipy.ndimage.maximum_filter(
+                        mask_selected, size=2 * args.mask_dilation + 1)
+            last_mask = mask_selected
+            write_frame(frame)
+        profiler.end_record(frames=record_frames, keyframes=len(keyframes))
+        record_frames = 0
+        print('\rframe {}: {:.2f} fps'.format(
+            num_frames, num_frames / (time.time() - start)),
+            end='', flush=True)
+
+    keyframes = []
+    last_signature = None
+    last_keyframe = 0
+    try:
+        for i, frame in enumerate(reader):
+            signature = frame_signature(frame)
+            is_keyframe = last_signature is None or \
+                i - last_keyframe >= args.keyframe_interval or \
+                scene_changed(signature, last_signature, args.scene_threshold)
+            if is_keyframe:
+                last_keyframe = i
+                last_signature = signature
+                num_keyframes += 1
+                keyframes.append(frame)
+                if len(keyframes) == args.batch_size:
+                    process(keyframes)
+                    keyframes = []
+            else:
+                if keyframes:
+                    process(keyframes)
+                    keyframes = []
+                write_frame(frame)
+        if keyframes:
+            process(keyframes)
+        if record_frames:
+            profiler.end_record(frames=record_frames, keyframes=0)
+    finally:
+        reader.close()
+        writer.close()
+
+    class_names = get_class_names()
+    for track_id, (class_id, first, last) in sorted(tracker.history.items()):
+        print('track {}: {}, keyframes {}-{}'.format(
+            track_id, class_names[class_id], first, last))
+
+    elapsed = time.time() - start
+    print('\r{} frames ({} keyframes) in {:.1f}s ({:.2f} fps) -> {}'.format(
+        num_frames, num_keyframes, elapsed, num_frames / elapsed, output))
 
 
 if __name__ == '__main__':
@@ -119,30 +623,178 @@ if __name__ == '__main__':
                     'in images using a neural network.')
     parser.add_argument('-i', '--image',  help='Image file name.',
                         required=False)
+    parser.add_argument('-b', '--batch',
+                        help='directory, glob pattern or manifest file ' +
+                        'of images to block in one run.',
+                        required=False)
+    parser.add_argument('-v', '--video',
+                        help='video file to block, frame by frame.',
+                        required=False)
+    parser.add_argument('--video-output', dest='video_output',
+                        help='output file for video mode (default: ' +
+                        'person_blocked with the input extension).',
+                        default=None)
+    parser.add_argument('--keyframe-interval', dest='keyframe_interval',
+                        type=int, default=1,
+                        help='in video mode, run detection every N frames ' +
+                        'and reuse the masks in between.')
+    parser.add_argument('--scene-threshold', dest='scene_threshold',
+                        type=float, default=0.,
+                        help='in video mode, also detect on frames that ' +
+                        'differ from the last keyframe by more than this ' +
+                        '(mean absolute difference, 0-255). 0 disables it.')
+    parser.add_argument('--mask-dilation', dest='mask_dilation',
+                        type=int, default=0,
+                        help='in video mode, grow masks by this many ' +
+                        'pixels to cover movement between keyframes.')
+    parser.add_argument('--track-iou', dest='track_iou',
+                        type=float, default=0.3,
+                        help='in video mode, minimum box overlap (IoU) ' +
+                        'to continue an object\'s track between keyframes.')
+    parser.add_argument('-d', '--output-dir', dest='output_dir',
+                        help='output directory for batch mode.',
+                        default='blocked')
+    parser.add_argument('--batch-size', dest='batch_size', type=int,
+                        help='images per forward pass in batch and ' +
+                        'video mode.',
+                        default=1)
     parser.add_argument(
         '-m', '--model',  help='path to COCO model', default=None)
+    parser.add_argument('--convert-weights', dest='convert_weights',
+                        help='convert the COCO model to the faster ' +
+                        'loading flat .weights format at this path, ' +
+                        'then exit.',
+                        default=None)
+    parser.add_argument('--export-graph', dest='export_graph',
+                        help='export the model as a frozen TensorFlow ' +
+                        'graph (' + FROZEN_GRAPH_EXTENSION + ') at this ' +
+                        'path, then exit. Uses --batch-size, ' +
+                        '--prune-classes, --preset and the flags that ' +
+                        'override its settings.',
+                        default=None)
     parser.add_argument('-o',
                         '--objects', nargs='+',
                         help='object(s)/object ID(s) to block. ' +
                         'Use the -names flag to print a list of ' +
                         'valid objects',
                         default='person')
+    parser.add_argument('--prune-classes', dest='prune_classes',
+                        action='store_true',
+                        help='only run the network heads for the ' +
+                        'selected types of objects. Faster, but other ' +
+                        'objects may be mistaken for them.')
+    parser.add_argument('--preset', choices=list(INFERENCE_PRESETS),
+                        default=None,
+                        help='speed/accuracy trade-off of the model ' +
+                        'settings (default: accurate, as trained). The ' +
+                        'flags below override single settings.')
+    parser.add_argument('--min-dim', dest='min_dim', type=int,
+                        help='scale images up so that their shorter ' +
+                        'side is at least this many pixels.',
+                        default=None)
+    parser.add_argument('--max-dim', dest='max_dim', type=int,
+                        help='scale images down so that their longer ' +
+                        'side is at most this many pixels. A multiple ' +
+                        'of 64.',
+                        default=None)
+    parser.add_argument('--padding', dest='padding', action='store_const',
+                        const=True,
+                        help='pad images to a max-dim by max-dim square.')
+    parser.add_argument('--no-padding', dest='padding', action='store_const',
+                        const=False,
+                        help='keep the aspect ratio of images, padded to ' +
+                        'a multiple of 64 only.')
+    parser.add_argument('--pre-nms-limit', dest='pre_nms_limit', type=int,
+                        help='top-scoring anchors to keep before ' +
+                        'non-max suppression of the proposals.',
+                        default=None)
+    parser.add_argument('--post-nms-rois', dest='post_nms_rois', type=int,
+                        help='proposals to keep after non-max suppression.',
+                        default=None)
+    parser.add_argument('--max-instances', dest='max_instances', type=int,
+                        help='maximum number of detected objects per ' +
+                        'image.',
+                        default=None)
+    parser.add_argument('--backbone', choices=['resnet50', 'resnet101'],
+                        help='backbone network. Needs weights trained ' +
+                        'with it (the COCO model uses resnet101).',
+                        default=None)
     parser.add_argument('-c',
                         '--color', nargs='?', default='(255, 255, 255)',
                         help='color of the "block"')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='random seed for the noise, for ' +
+                        'deterministic output.')
     parser.add_argument('-l',
                         '--labeled', dest='labeled',
                         action='store_true',
                         help='generate labeled image instead')
+    parser.add_argument('--profile', choices=['table', 'jsonl'],
+                        default=None,
+                        help='time the stages of the pipeline and print a ' +
+                        'summary table at the end, or write one JSON ' +
+                        'line per image (per batch in batch and video ' +
+                        'mode) to --profile-output.')
+    parser.add_argument('--profile-output', dest='profile_output',
+                        help='file for --profile jsonl (default: stderr).',
+                        default=None)
     parser.add_argument('-n',
                         '--names', dest='names',
                         action='store_true',
                         help='prints class names and exits.')
-    parser.set_defaults(labeled=False, names=False)
+    parser.set_defaults(labeled=False, names=False, prune_classes=False,
+                        padding=None)
     args = parser.parse_args()
 
     if args.names:
         print(get_class_names())
         sys.exit()
 
-    person_blocker(args)
+    if args.convert_weights:
+        convert_weights(args.model, args.convert_weights)
+        sys.exit()
+
+    if args.prune_classes and selected_class_ids(args.objects) is None:
+        parser.error('--prune-classes requires --objects to be object types.')
+
+    if args.batch_size <= 0:
+        parser.error('--batch-size must be at least 1.')
+
+    if args.max_dim is not None and (args.max_dim <= 0 or args.max_dim % 64):
+        parser.error('--max-dim must be a multiple of 64.')
+
+    for flag in ['min_dim', 'pre_nms_limit', 'post_nms_rois',
+                 'max_instances']:
+        if getattr(args, flag) is not None and getattr(args, flag) <= 0:
+            parser.error('--{} must be positive.'.format(
+                flag.replace('_', '-')))
+
+    # Compare the dimensions that apply, given by flags or by the preset
+    settings = dict(INFERENCE_PRESETS[args.preset] if args.preset else {})
+    settings.update(config_overrides(args))
+    min_dim = settings.get('IMAGE_MIN_DIM', InferenceConfig.IMAGE_MIN_DIM)
+    max_dim = settings.get('IMAGE_MAX_DIM', InferenceConfig.IMAGE_MAX_DIM)
+    if min_dim > max_dim:
+        parser.error('--min-dim ({}) must not be larger than --max-dim '
+                     '({}).'.format(min_dim, max_dim))
+
+    if args.export_graph:
+        export_graph(args)
+        sys.exit()
+
+    if (args.batch or args.video) and args.labeled:
+        parser.error('--labeled is only supported for a single image.')
+
+    profiler = make_profiler(args.profile, args.profile_output)
+    try:
+        if args.video:
+            person_blocker_video(args, profiler)
+        elif args.batch:
+            person_blocker_batch(args, profiler)
+        else:
+            person_blocker(args, profiler)
+    finally:
+        if profiler is not None:
+            profiler.close()
+    if args.profile == 'table':
+        print(profiler.summary())
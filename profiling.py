@@ -0,0 +1,195 @@
+import sys
+import json
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Lightweight instrumentation for the detect and blocking pipeline.
+# Code under measurement wraps its steps in profiler.stage(name) and
+# adds counters with profiler.count(name, value). Stage times and
+# counters accumulate into the current record until end_record() closes
+# it, usually once per image (or per batch of images). Each closed record
+# can be written as a JSON line, and summary() aggregates all records
+# into a table.
+#
+#     profiler = Profiler(stream=sys.stderr)
+#     with profiler.stage('imread'):
+#         image = imageio.imread(path)
+#     r = model.detect([image], profiler=profiler)[0]
+#     profiler.end_record(image=path)
+#     print(profiler.summary())
+#
+# Code that takes an optional profiler uses NULL_PROFILER when none is
+# given, which does nothing.
+#
+# Every record also has the peak resident memory of the process so far.
+#
+# One-time setup, like loading the model, goes in profiler.setup(name)
+# instead. It is timed on its own and the current record restarts after
+# it, so that the first record isn't skewed by it.
+
+
+def peak_rss_mb():
+    """Returns the peak resident set size of this process in MB, or None
+    where it isn't available.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return peak / 1024. ** 2 if sys.platform == 'darwin' else peak / 1024.
+
+
+class Profiler(object):
+
+    def __init__(self, stream=None, close_stream=False):
+        """
+        stream: Optional file to write each record to as a JSON line,
+            when it's closed.
+        close_stream: If True, close() also closes stream. Set it when the
+            profiler owns the file, e.g. one opened for --profile-output.
+        """
+        self.stream = stream
+        self.close_stream = close_stream
+        self.records = []
+        self.setup_ms = OrderedDict()
+        self._reset()
+
+    def _reset(self):
+        self._start = time.perf_counter()
+        self._stages = OrderedDict()
+        self._counters = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        """Times the enclosed block and adds it to the stage `name` of the
+        current record. Stages may repeat and may be nested, in which case
+        the outer stage includes the inner ones.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._stages[name] = self._stages.get(name, 0.) + \
+                time.perf_counter() - start
+
+    @contextmanager
+    def setup(self, name):
+        """Times the enclosed one-time setup into setup_ms[name], outside
+        of the records, and restarts the current record after it.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.setup_ms[name] = self.setup_ms.get(name, 0.) + \
+                (time.perf_counter() - start) * 1000.
+            self._reset()
+
+    def count(self, name, value=1):
+        """Adds value to the counter `name` of the current record."""
+        self._counters[name] = self._counters.get(name, 0) + value
+
+    def end_record(self, **fields):
+        """Closes the current record, with the given extra fields (e.g. the
+        image path), and starts a new one. Returns the record.
+        """
+        record = OrderedDict(fields)
+        record['total_ms'] = (time.perf_counter() - self._start) * 1000.
+        record['peak_rss_mb'] = peak_rss_mb()
+        record['stages_ms'] = OrderedDict(
+            (name, seconds * 1000.) for name, seconds in self._stages.items())
+        record['counters'] = self._counters
+        self.records.append(record)
+        if self.stream is not None:
+            self.stream.write(json.dumps(record) + '\n')
+            self.stream.flush()
+        self._reset()
+        return record
+
+    def summary(self):
+        """Returns a table with the total and mean time of every stage and
+        the total of every counter over all closed records.
+        """
+        stages = OrderedDict()
+        counters = OrderedDict()
+        total = 0.
+        for record in self.records:
+            total += record['total_ms']
+            for name, ms in record['stages_ms'].items():
+                calls, stage_total = stages.get(name, (0, 0.))
+                stages[name] = (calls + 1, stage_total + ms)
+            for name, value in record['counters'].items():
+                counters[name] = counters.get(name, 0) + value
+
+        lines = ['{:24} {:>8} {:12.1f}'.format(name, 'setup', ms)
+                 for name, ms in self.setup_ms.items()]
+        lines.append('{:24} {:>8} {:>12} {:>10} {:>7}'.format(
+            'stage', 'records', 'total_ms', 'mean_ms', '%'))
+        for name, (calls, stage_total) in stages.items():
+            lines.append('{:24} {:8d} {:12.1f} {:10.2f} {:6.1f}%'.format(
+                name, calls, stage_total, stage_total / calls,
+                100. * stage_total / total if total else 0.))
+        lines.append('{:24} {:8d} {:12.1f} {:10.2f}'.format(
+            'total', len(self.records), total,
+            total / len(self.records) if self.records else 0.))
+        for name, value in counters.items():
+            lines.append('{:24} {:>8} {:12.1f}'.format(name, '', value)
+                         if isinstance(value, float) else
+                         '{:24} {:>8} {:12d}'.format(name, '', value))
+        if self.records and self.records[-1]['peak_rss_mb'] is not None:
+            lines.append('{:24} {:>8} {:12.1f}'.format(
+                'peak_rss_mb', '', self.records[-1]['peak_rss_mb']))
+        return '\n'.join(lines)
+
+    def close(self):
+        """Closes the stream if the profiler owns it. Records are kept."""
+        if self.close_stream and self.stream is not None:
+            self.stream.close()
+        self.stream = None
+
+
+class NullProfiler(Profiler):
+    """A Profiler that doesn't measure or record anything."""
+
+    def __init__(self):
+        self.stream = None
+        self.close_stream = False
+        self.records = []
+        self.setup_ms = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        yield
+
+    @contextmanager
+    def setup(self, name):
+        yield
+
+    def count(self, name, value=1):
+        pass
+
+    def end_record(self, **fields):
+        return None
+
+
+NULL_PROFILER = NullProfiler()
+
+
+def make_profiler(mode, output=None):
+    """Returns the profiler for a --profile option: None when mode is
+    None, a Profiler that writes JSON lines to output (or stderr) for
+    'jsonl', and one that only keeps records for 'table'. Call close()
+    on it when done, to close the output file.
+    """
+    if mode is None:
+        return None
+    if mode == 'jsonl':
+        if output:
+            return Profiler(stream=open(output, 'w'), close_stream=True)
+        return Profiler(stream=sys.stderr)
+    return Profiler()
@@ -0,0 +1,192 @@
+import sys
+import time
+import argparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import imageio
+from person_blocker import (load_model, select_objects, selected_class_ids,
+                            block_frames, block_regions, paste_region,
+                            encode_blocked_gif, string_to_rgb_triplet,
+                            NoiseBank)
+from batching import BatchScheduler
+from classes import INFERENCE_PRESETS
+
+# Long-running inference server. The model is built and its weights
+# are loaded once at startup, then every request reuses it. Requests
+# are handled concurrently and micro-batched into shared forward passes
+# by a BatchScheduler.
+#
+# POST /block?objects=person&color=%23c0392b&format=png
+#   body: the encoded image (any format imageio can read)
+#   format: png (blocked image), gif (animated "static") or
+#           mask (PNG of the selected objects' mask)
+# GET /health
+
+CONTENT_TYPES = {'png': 'image/png',
+                 'gif': 'image/gif',
+                 'mask': 'image/png'}
+
+
+# Parses the color parameter like the CLI does, but raises ValueError
+# for anything that isn't an RGB triplet of 0-255 values, so that bad
+# input can be answered with 400.
+
+def parse_color(color):
+
+    try:
+        triplet = string_to_rgb_triplet(color)
+    except Exception:
+        triplet = None
+    if not (isinstance(triplet, tuple) and len(triplet) == 3 and
+            all(isinstance(v, int) and 0 <= v <= 255 for v in triplet)):
+        raise ValueError('color must be "#rrggbb" or "(r, g, b)" with '
+                         'values from 0 to 255, got {!r}'.format(color))
+    return triplet
+
+
+def encode_result(image, mask_selected, mask_color, output_format,
+                  noise_bank=None):
+
+    if output_format == 'mask':
+        mask = np.where(mask_selected > 0, 255, 0).astype(np.uint8)
+        return imageio.imwrite(imageio.RETURN_BYTES, mask, format='png')
+
+    if output_format == 'png':
+        images = block_frames(image, mask_selected, mask_color, 1, noise_bank)
+        return imageio.imwrite(imageio.RETURN_BYTES, images[0], format='png')
+
+    box, box_mask, regions = block_regions(image, mask_selected, mask_color,
+                                           10, noise_bank)
+    image_masked = paste_region(image, box, regions[0] if regions else None)
+    return encode_blocked_gif(image_masked, box, box_mask, regions[1:])
+
+
+class BlockerHandler(BaseHTTPRequestHandler):
+    # Set by serve() before the server starts accepting requests
+    scheduler = None
+    noise_bank = None
+
+    def send_body(self, status, body, content_type='text/plain', headers=None):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/health':
+            self.send_body(200, 'ok')
+        else:
+            self.send_body(404, 'not found')
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/block':
+            self.send_body(404, 'not found')
+            return
+
+        params = parse_qs(url.query)
+        objects = params.get('objects', ['person'])
+        output_format = params.get('format', ['png'])[0]
+        if output_format not in CONTENT_TYPES:
+            self.send_body(400, 'format must be one of: {}'.format(
+                ', '.join(sorted(CONTENT_TYPES))))
+            return
+        try:
+            mask_color = parse_color(
+                params.get('color', ['(255, 255, 255)'])[0])
+        except ValueError as e:
+            self.send_body(400, str(e))
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            self.send_body(400, 'Content-Length must be an integer')
+            return
+        if length <= 0:
+            self.send_body(400, 'request body must contain an image')
+            return
+
+        start = time.time()
+        try:
+            image = imageio.imread(self.rfile.read(length))
+        except Exception as e:
+            # Decoders disagree on what they raise for a malformed body
+            # (ValueError, OSError, even SyntaxError from PIL), but
+            # anything failing here is the client's image
+            self.send_body(400, 'could not decode image: {}'.format(e))
+            return
+
+        try:
+            r = self.scheduler.detect(image)
+            mask_selected = select_objects(r, objects)
+            body = encode_result(image, mask_selected, mask_color,
+                                 output_format, self.noise_bank)
+            elapsed = time.time() - start
+        except Exception as e:
+            self.send_body(500, '{}: {}'.format(type(e).__name__, e))
+            return
+
+        self.send_body(200, body, CONTENT_TYPES[output_format],
+                       {'X-Processing-Time': '{:.4f}'.format(elapsed)})
+
+    def log_message(self, format, *args):
+        sys.stderr.write('[{}] {}\n'.format(self.log_date_time_string(),
+                                            format % args))
+
+
+def serve(model, host='127.0.0.1', port=5000, max_batch_size=None,
+          max_wait_ms=10.):
+
+    scheduler = BatchScheduler(model, max_batch_size, max_wait_ms,
+                               detect_kwargs={'sparse_masks': True})
+    BlockerHandler.scheduler = scheduler
+    BlockerHandler.noise_bank = NoiseBank()
+    httpd = ThreadingHTTPServer((host, port), BlockerHandler)
+    print('Person Blocker server listening on http://{}:{} '
+          '(max batch size {}, max wait {} ms)'.format(
+              host, port, scheduler.max_batch_size, max_wait_ms))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        scheduler.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Person Blocker server - keeps the model loaded and '
+                    'blocks images sent over localhost HTTP.')
+    parser.add_argument(
+        '-m', '--model',  help='path to COCO model', default=None)
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='address to bind to (default: localhost only)')
+    parser.add_argument('-p', '--port', type=int, default=5000,
+                        help='port to listen on')
+    parser.add_argument('--max-batch-size', type=int, default=1,
+                        help='maximum number of images per forward pass')
+    parser.add_argument('--max-wait-ms', type=float, default=10.,
+                        help='how long to wait for a batch to fill up')
+    parser.add_argument('--classes', nargs='+', default=None,
+                        help='only detect these types of objects, which ' +
+                        'shrinks the network heads (default: all)')
+    parser.add_argument('--preset', choices=list(INFERENCE_PRESETS),
+                        default=None,
+                        help='speed/accuracy trade-off of the model ' +
+                        'settings (default: accurate, as trained)')
+    args = parser.parse_args()
+
+    class_ids = selected_class_ids(args.classes) if args.classes else None
+    if args.classes and class_ids is None:
+        parser.error('--classes must be object types.')
+    model = load_model(args.model, batch_size=args.max_batch_size,
+                       class_ids=class_ids, preset=args.preset)
+    serve(model, args.host, args.port, args.max_batch_size, args.max_wait_ms)
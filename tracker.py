@@ -0,0 +1,95 @@
+import numpy as np
+import utils
+
+# Lightweight IoU tracker. Detection order from MaskRCNN.detect() is not
+# stable between frames, so positional object IDs can't be used to pick
+# objects in a video. The tracker matches each frame's detections to the
+# tracks of the previous frames by bounding box overlap and gives every
+# object a track ID that stays the same for as long as it's visible.
+
+
+class IoUTracker(object):
+
+    def __init__(self, iou_threshold=0.3, max_age=5):
+        """
+        iou_threshold: minimum box IoU for a detection to continue a track.
+        max_age: number of updates a track can go unmatched before it's
+            dropped, e.g. when a person is briefly occluded.
+        """
+        self.iou_threshold = iou_threshold
+        self.max_age = max_age
+        self.next_id = 0
+        self.num_updates = 0
+
+        # Active tracks, one row each
+        self.boxes = np.zeros((0, 4), dtype=np.int32)
+        self.class_ids = np.zeros((0,), dtype=np.int32)
+        self.track_ids = np.zeros((0,), dtype=np.int32)
+        self.ages = np.zeros((0,), dtype=np.int32)
+
+        # track_id -> (class_id, first update, last update) of every track
+        # seen so far
+        self.history = {}
+
+    def match(self, boxes, class_ids):
+        """Greedily matches detections to tracks by highest IoU first.
+        Only detections and tracks of the same class are matched.
+
+        Returns an array [N] with the index of the matched track for each
+        detection, or -1.
+        """
+        matches = np.full(boxes.shape[0], -1, dtype=np.int32)
+        if not boxes.shape[0] or not self.boxes.shape[0]:
+            return matches
+
+        # [detections, tracks]
+        overlaps = utils.compute_overlaps(boxes, self.boxes)
+        overlaps[class_ids[:, None] != self.class_ids[None, :]] = 0
+
+        # Candidate pairs above the threshold, best first
+        det_ix, track_ix = np.where(overlaps >= self.iou_threshold)
+        order = np.argsort(-overlaps[det_ix, track_ix], kind="stable")
+        track_used = np.zeros(self.boxes.shape[0], dtype=bool)
+        for d, t in zip(det_ix[order], track_ix[order]):
+            if matches[d] < 0 and not track_used[t]:
+                matches[d] = t
+                track_used[t] = True
+        return matches
+
+    def update(self, boxes, class_ids):
+        """Updates the tracks with the detections of a new frame.
+        boxes: [N, (y1, x1, y2, x2)] detection boxes, e.g. r['rois']
+        class_ids: [N] class IDs, e.g. r['class_ids']
+
+        Returns an array [N] of track IDs, one per detection.
+        """
+        boxes = np.asarray(boxes).reshape(-1, 4)
+        class_ids = np.asarray(class_ids).astype(np.int32)
+        matches = self.match(boxes, class_ids)
+
+        # Continue matched tracks and start new ones for the rest
+        matched = matches >= 0
+        track_ids = np.zeros(boxes.shape[0], dtype=np.int32)
+        track_ids[matched] = self.track_ids[matches[matched]]
+        new = np.flatnonzero(~matched)
+        track_ids[new] = np.arange(self.next_id, self.next_id + new.shape[0])
+        self.next_id += new.shape[0]
+
+        # Keep unmatched tracks around until they're too old
+        unmatched = np.ones(self.boxes.shape[0], dtype=bool)
+        unmatched[matches[matched]] = False
+        keep = unmatched & (self.ages < self.max_age)
+
+        self.boxes = np.concatenate([boxes.astype(np.int32),
+                                     self.boxes[keep]])
+        self.class_ids = np.concatenate([class_ids, self.class_ids[keep]])
+        self.track_ids = np.concatenate([track_ids, self.track_ids[keep]])
+        self.ages = np.concatenate([np.zeros_like(track_ids),
+                                    self.ages[keep] + 1])
+
+        for track_id, class_id in zip(track_ids, class_ids):
+            first = self.history.get(track_id, (0, self.num_updates))[1]
+            self.history[int(track_id)] = (int(class_id), first,
+                                           self.num_updates)
+        self.num_updates += 1
+        return track_ids
@@ -10,7 +10,12 @@ Written by Waleed Abdulla
 import sys
 import os
 import math
+import time
+import json
+import hashlib
+import functools
 import random
+from collections import OrderedDict
 import numpy as np
 import tensorflow as tf
 import scipy.misc
@@ -381,28 +386,87 @@ class Dataset(object):
         return mask, class_ids
 
 
-def resize_image(image, min_dim=None, max_dim=None, padding=False):
+@functools.lru_cache(maxsize=256)
+def area_resize_weights(in_size, out_size):
+    """Returns (indices, weights), each [taps, out_size], to resample a 1D
+    signal of length in_size to length out_size by area averaging: each
+    output value is the mean of the input over the interval it covers.
+    Output i is sum(weights[k, i] * x[indices[k, i]] for k in taps).
     """
-    Resizes an image keeping the aspect ratio.
+    step = in_size / out_size
+    starts = np.arange(out_size) * step
+    ends = starts + step
+    taps = int(math.ceil(step)) + 1
+    indices = np.floor(starts).astype(np.int32) + np.arange(taps)[:, np.newaxis]
+    overlap = np.minimum(ends, indices + 1) - np.maximum(starts, indices)
+    weights = np.maximum(overlap, 0) / step
+    return np.minimum(indices, in_size - 1), weights.astype(np.float32)
+
+
+def resize_area(image, size):
+    """Pure NumPy area resampling of an [height, width, ...] image to
+    size (height, width). Returns float32.
+    """
+    for axis, out_size in enumerate(size):
+        indices, weights = area_resize_weights(image.shape[axis], out_size)
+        shape = [1] * image.ndim
+        shape[axis] = out_size
+        resized = np.take(image, indices[0], axis=axis).astype(np.float32)
+        resized *= weights[0].reshape(shape)
+        for k in range(1, indices.shape[0]):
+            resized += np.take(image, indices[k], axis=axis) * \
+                weights[k].reshape(shape)
+        image = resized
+    return image
+
+
+def resize_pil(image, size):
+    """Bilinear resize of a uint8 image to size (height, width) with PIL,
+    as scipy.misc.imresize() used to do. Returns uint8.
+    """
+    from PIL import Image
+    return np.asarray(Image.fromarray(image).resize(
+        (size[1], size[0]), Image.BILINEAR))
+
+
+def resize_skimage(image, size):
+    """Bilinear resize of an image to size (height, width) with
+    scikit-image. Returns float64 in the value range of the input.
+    """
+    import skimage.transform
+    return skimage.transform.resize(
+        image, tuple(size) + image.shape[2:], order=1, mode="constant",
+        preserve_range=True)
+
+
+# Image resize functions by name. See Config.RESIZE_BACKEND.
+RESIZE_BACKENDS = {
+    "pil": resize_pil,
+    "skimage": resize_skimage,
+    "area": resize_area,
+}
 
-    min_dim: if provided, resizes the image such that it's smaller
-        dimension == min_dim
-    max_dim: if provided, ensures that the image longest side doesn't
-        exceed this value.
-    padding: If true, pads image with zeros so it's size is max_dim x max_dim
+
+def resize(image, size, backend="pil"):
+    """Resizes an image to size (height, width) with one of the
+    RESIZE_BACKENDS. The result may be float; callers that need the
+    input dtype have to convert it.
+    """
+    return RESIZE_BACKENDS[backend](image, size)
+
+
+def resize_geometry(h, w, min_dim=None, max_dim=None, padding=False):
+    """Computes how resize_image() resizes and pads an image of size
+    h x w, without touching any pixels.
 
     Returns:
-    image: the resized image
-    window: (y1, x1, y2, x2). If max_dim is provided, padding might
-        be inserted in the returned image. If so, this window is the
-        coordinates of the image part of the full image (excluding
-        the padding). The x2, y2 pixels are not included.
+    size: (height, width) of the resized image, before padding
+    window: (y1, x1, y2, x2) of the resized image in the padded image
     scale: The scale factor used to resize the image
     padding: Padding added to the image [(top, bottom), (left, right), (0, 0)]
+        or False if padding is False
     """
-    # Default window (y1, x1, y2, x2) and default scale == 1.
-    h, w = image.shape[:2]
-    window = (0, 0, h, w)
+    # Default scale == 1.
     scale = 1
 
     # Scale?
@@ -414,21 +478,52 @@ def resize_image(image, min_dim=None, max_dim=None, padding=False):
         image_max = max(h, w)
         if round(image_max * scale) > max_dim:
             scale = max_dim / image_max
-    # Resize image and mask
     if scale != 1:
-        image = scipy.misc.imresize(
-            image, (round(h * scale), round(w * scale)))
+        h, w = round(h * scale), round(w * scale)
+    window = (0, 0, h, w)
     # Need padding?
     if padding:
-        # Get new height and width
-        h, w = image.shape[:2]
         top_pad = (max_dim - h) // 2
         bottom_pad = max_dim - h - top_pad
         left_pad = (max_dim - w) // 2
         right_pad = max_dim - w - left_pad
         padding = [(top_pad, bottom_pad), (left_pad, right_pad), (0, 0)]
-        image = np.pad(image, padding, mode='constant', constant_values=0)
         window = (top_pad, left_pad, h + top_pad, w + left_pad)
+    return (h, w), window, scale, padding
+
+
+def resize_image(image, min_dim=None, max_dim=None, padding=False,
+                 backend="pil"):
+    """
+    Resizes an image keeping the aspect ratio.
+
+    min_dim: if provided, resizes the image such that it's smaller
+        dimension == min_dim
+    max_dim: if provided, ensures that the image longest side doesn't
+        exceed this value.
+    padding: If true, pads image with zeros so it's size is max_dim x max_dim
+    backend: Name of the resize function in RESIZE_BACKENDS
+
+    Returns:
+    image: the resized image
+    window: (y1, x1, y2, x2). If max_dim is provided, padding might
+        be inserted in the returned image. If so, this window is the
+        coordinates of the image part of the full image (excluding
+        the padding). The x2, y2 pixels are not included.
+    scale: The scale factor used to resize the image
+    padding: Padding added to the image [(top, bottom), (left, right), (0, 0)]
+    """
+    size, window, scale, padding = resize_geometry(
+        image.shape[0], image.shape[1], min_dim, max_dim, padding)
+    # Resize image and mask
+    if scale != 1:
+        resized = resize(image, size, backend)
+        if resized.dtype != image.dtype:
+            resized = np.round(resized).astype(image.dtype)
+        image = resized
+    # Need padding?
+    if padding:
+        image = np.pad(image, padding, mode='constant', constant_values=0)
     return image, window, scale, padding
 
 
@@ -487,6 +582,43 @@ def mold_mask(mask, config):
     pass
 
 
+@functools.lru_cache(maxsize=1024)
+def bilinear_resize_matrix(in_size, out_size):
+    """Returns a [out_size, in_size] float32 matrix that resamples a 1D
+    signal of length in_size to length out_size with bilinear
+    interpolation (pixel centers aligned, edges clamped). A 2D array x
+    of shape [h, w] is resized to [out_h, out_w] with
+    bilinear_resize_matrix(h, out_h) @ x @ bilinear_resize_matrix(w, out_w).T.
+    """
+    centers = (np.arange(out_size, dtype=np.float32) + 0.5) * \
+        (in_size / out_size) - 0.5
+    centers = np.clip(centers, 0, in_size - 1)
+    low = np.floor(centers).astype(np.int32)
+    high = np.minimum(low + 1, in_size - 1)
+    frac = centers - low
+    matrix = np.zeros([out_size, in_size], dtype=np.float32)
+    rows = np.arange(out_size)
+    np.add.at(matrix, (rows, low), 1 - frac)
+    np.add.at(matrix, (rows, high), frac)
+    return matrix
+
+
+def unmold_mask_crop(mask, bbox):
+    """Resizes a mask generated by the neural network to the size of its
+    bounding box and applies the boundary threshold.
+    mask: [height, width] of type float. A small, typically 28x28 mask.
+    bbox: [y1, x1, y2, x2]. The box to fit the mask in.
+
+    Returns a binary uint8 mask of size [y2 - y1, x2 - x1].
+    """
+    threshold = 0.5
+    y1, x1, y2, x2 = bbox
+    mask = bilinear_resize_matrix(mask.shape[0], y2 - y1).dot(
+        mask.astype(np.float32)).dot(
+        bilinear_resize_matrix(mask.shape[1], x2 - x1).T)
+    return (mask >= threshold).astype(np.uint8)
+
+
 def unmold_mask(mask, bbox, image_shape):
     """Converts a mask generated by the neural network into a format similar
     to it's original shape.
@@ -495,11 +627,8 @@ def unmold_mask(mask, bbox, image_shape):
 
     Returns a binary mask with the same size as the original image.
     """
-    threshold = 0.5
     y1, x1, y2, x2 = bbox
-    mask = scipy.misc.imresize(
-        mask, (y2 - y1, x2 - x1), interp='bilinear').astype(np.float32) / 255.0
-    mask = np.where(mask >= threshold, 1, 0).astype(np.uint8)
+    mask = unmold_mask_crop(mask, bbox)
 
     # Put the mask in the right location.
     full_mask = np.zeros(image_shape[:2], dtype=np.uint8)
@@ -507,6 +636,162 @@ def unmold_mask(mask, bbox, image_shape):
     return full_mask
 
 
+def unmold_masks(masks, boxes, image_shape, sparse=False):
+    """Unmolds all instance masks of an image, like calling unmold_mask()
+    on each of them.
+    masks: [N, height, width] of type float. Small, typically 28x28 masks.
+    boxes: [N, (y1, x1, y2, x2)]. The boxes to fit the masks in.
+    image_shape: [height, width, ...] of the original image.
+    sparse: If True, return an InstanceMasks instead of a dense array.
+
+    Masks are still processed one instance at a time, but each one is
+    resized to its box in float with two small matrix products (see
+    bilinear_resize_matrix()) instead of an 8-bit image round trip, and
+    the crops are pasted into one shared output buffer, so there's no
+    full-size allocation per instance.
+
+    Returns [height, width, N] uint8 binary masks, or an InstanceMasks.
+    """
+    boxes = np.asarray(boxes, dtype=np.int32).reshape([-1, 4])
+    crops = [unmold_mask_crop(mask, box) for mask, box in zip(masks, boxes)]
+    if sparse:
+        return InstanceMasks(boxes, crops, image_shape)
+
+    # Fill an instance-major buffer, where each paste is a contiguous
+    # write, and return it as a [height, width, N] view.
+    full_masks = np.zeros((len(crops),) + tuple(image_shape[:2]),
+                          dtype=np.uint8)
+    for i, ((y1, x1, y2, x2), crop) in enumerate(zip(boxes, crops)):
+        full_masks[i, y1:y2, x1:x2] = crop
+    return np.moveaxis(full_masks, 0, -1)
+
+
+class InstanceMasks(object):
+    """Compact alternative to a dense [height, width, num_instances] mask
+    array. Each instance is stored as its bounding box and a binary mask
+    cropped to that box, so memory grows with the area of the objects
+    rather than with the image size times the instance count.
+
+    Supports the indexing used with dense masks: masks[:, :, i] returns
+    the dense [height, width] mask of instance i, and masks[:, :, indices]
+    returns an InstanceMasks with a subset of the instances. shape, len()
+    and iteration over (box, crop) pairs work as expected, and dense() or
+    np.array(masks) densifies everything.
+    """
+
+    def __init__(self, boxes, crops, image_shape):
+        """
+        boxes: [N, (y1, x1, y2, x2)] in image coordinates.
+        crops: list of N binary masks, each of size [y2 - y1, x2 - x1].
+        image_shape: [height, width, ...] of the image.
+        """
+        self.boxes = np.asarray(boxes, dtype=np.int32).reshape([-1, 4])
+        self.crops = list(crops)
+        self.image_shape = tuple(image_shape[:2])
+        assert self.boxes.shape[0] == len(self.crops)
+
+    @property
+    def shape(self):
+        return self.image_shape + (len(self.crops),)
+
+    def __len__(self):
+        return len(self.crops)
+
+    def __iter__(self):
+        return zip(self.boxes, self.crops)
+
+    def instance(self, i):
+        """Returns the dense [height, width] uint8 mask of instance i."""
+        y1, x1, y2, x2 = self.boxes[i]
+        mask = np.zeros(self.image_shape, dtype=np.uint8)
+        mask[y1:y2, x1:x2] = self.crops[i]
+        return mask
+
+    def subset(self, indices):
+        """Returns an InstanceMasks with only the given instances."""
+        indices = np.arange(len(self.crops))[indices]
+        return InstanceMasks(self.boxes[indices],
+                             [self.crops[i] for i in indices],
+                             self.image_shape)
+
+    def union(self, indices=None):
+        """Returns a [height, width] bool mask of the union of the given
+        instances (all by default)."""
+        masks = self if indices is None else self.subset(indices)
+        union = np.zeros(self.image_shape, dtype=bool)
+        for (y1, x1, y2, x2), crop in masks:
+            union[y1:y2, x1:x2] |= crop.astype(bool)
+        return union
+
+    def dense(self):
+        """Returns the dense [height, width, N] uint8 mask array."""
+        masks = np.zeros(self.shape, dtype=np.uint8)
+        for i, ((y1, x1, y2, x2), crop) in enumerate(self):
+            masks[y1:y2, x1:x2, i] = crop
+        return masks
+
+    def __array__(self, dtype=None, copy=None):
+        masks = self.dense()
+        return masks if dtype is None else masks.astype(dtype)
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple) and len(key) == 3 and \
+                key[0] == slice(None) and key[1] == slice(None):
+            if isinstance(key[2], (int, np.integer)):
+                return self.instance(key[2])
+            return self.subset(key[2])
+        return self.dense()[key]
+
+
+def union_masks(masks):
+    """Returns the [height, width] bool union of a dense
+    [height, width, N] mask array or an InstanceMasks.
+    """
+    if isinstance(masks, InstanceMasks):
+        return masks.union()
+    return np.any(masks, axis=2)
+
+
+class BufferPool(object):
+    """Keeps arrays by name for reuse across calls, e.g. the input batch of
+    MaskRCNN.detect(), to avoid allocating them every time.
+
+    get() returns the kept array if its shape and dtype match, otherwise
+    it allocates a new one and keeps that instead. Contents are not
+    cleared, and a buffer is overwritten by the next user of its name, so
+    it must not be held on to or returned to callers.
+    """
+
+    def __init__(self):
+        self.buffers = {}
+        # Statistics
+        self.num_allocations = 0
+        self.num_reuses = 0
+        self.allocated_bytes = 0
+        self.allocation_seconds = 0.
+
+    def get(self, name, shape, dtype):
+        shape = tuple(int(x) for x in shape)
+        dtype = np.dtype(dtype)
+        buffer = self.buffers.get(name)
+        if buffer is not None and buffer.shape == shape and \
+                buffer.dtype == dtype:
+            self.num_reuses += 1
+            return buffer
+
+        start = time.perf_counter()
+        buffer = np.empty(shape, dtype=dtype)
+        self.allocation_seconds += time.perf_counter() - start
+        self.num_allocations += 1
+        self.allocated_bytes += buffer.nbytes
+        self.buffers[name] = buffer
+        return buffer
+
+    def clear(self):
+        """Releases all buffers."""
+        self.buffers = {}
+
+
 ############################################################
 #  Anchors
 ############################################################
@@ -570,6 +855,96 @@ def generate_pyramid_anchors(scales, ratios, feature_shapes, feature_strides,
     return np.concatenate(anchors, axis=0)
 
 
+def compute_backbone_shapes(image_shape, feature_strides):
+    """Returns the [height, width] of each feature map of the backbone for
+    input images of the given size, [len(feature_strides), 2].
+    """
+    return np.array(
+        [[int(math.ceil(image_shape[0] / stride)),
+          int(math.ceil(image_shape[1] / stride))]
+         for stride in feature_strides])
+
+
+class AnchorCache(object):
+    """Memoizes generate_pyramid_anchors() by its arguments, so that a model
+    and its data generators, or repeated inputs of the same size, share one
+    array of anchors instead of generating it again.
+
+    The max_size most recently used arrays are kept in memory. If cache_dir
+    is given, arrays are also saved there as .npy files and loaded from
+    there on a miss, which saves generating them again in later runs.
+    Returned arrays are shared, so they're read-only.
+    """
+
+    def __init__(self, max_size=8, cache_dir=None):
+        self.max_size = max_size
+        self.cache_dir = cache_dir
+        self.anchors = OrderedDict()
+        # Statistics
+        self.num_hits = 0
+        self.num_disk_hits = 0
+        self.num_misses = 0
+
+    @staticmethod
+    def key(scales, ratios, feature_shapes, feature_strides, anchor_stride):
+        """Returns the hashable cache key of a set of anchor settings."""
+        return (tuple(np.asarray(scales).tolist()),
+                tuple(np.asarray(ratios).tolist()),
+                tuple(tuple(shape) for shape in
+                      np.asarray(feature_shapes).tolist()),
+                tuple(np.asarray(feature_strides).tolist()),
+                int(anchor_stride))
+
+    def cache_path(self, key):
+        """Returns the path of the .npy file for key in cache_dir."""
+        digest = hashlib.sha1(repr(key).encode("utf8")).hexdigest()
+        return os.path.join(self.cache_dir, "anchors_{}.npy".format(digest))
+
+    def get(self, scales, ratios, feature_shapes, feature_strides,
+            anchor_stride):
+        """Returns the anchors generate_pyramid_anchors() returns for the same
+        arguments.
+        """
+        key = self.key(scales, ratios, feature_shapes, feature_strides,
+                       anchor_stride)
+        anchors = self.anchors.get(key)
+        if anchors is not None:
+            self.num_hits += 1
+            self.anchors.move_to_end(key)
+            return anchors
+
+        path = self.cache_path(key) if self.cache_dir else None
+        if path and os.path.exists(path):
+            try:
+                anchors = np.load(path)
+                self.num_disk_hits += 1
+            except (IOError, ValueError):
+                # Partly written or corrupt. Generate and save it again.
+                anchors = None
+        if anchors is None:
+            self.num_misses += 1
+            anchors = generate_pyramid_anchors(scales, ratios, feature_shapes,
+                                               feature_strides, anchor_stride)
+            if path:
+                # Write to a temporary file first so that concurrent
+                # processes never load a partial file
+                os.makedirs(self.cache_dir, exist_ok=True)
+                temp_path = "{}.{}.tmp".format(path, os.getpid())
+                with open(temp_path, "wb") as f:
+                    np.save(f, anchors)
+                os.replace(temp_path, path)
+
+        anchors.setflags(write=False)
+        self.anchors[key] = anchors
+        while len(self.anchors) > self.max_size:
+            self.anchors.popitem(last=False)
+        return anchors
+
+    def clear(self):
+        """Releases all arrays kept in memory. Files in cache_dir are kept."""
+        self.anchors = OrderedDict()
+
+
 ############################################################
 #  Miscellaneous
 ############################################################
@@ -727,3 +1102,90 @@ def download_trained_weights(coco_model_path, verbose=1):
         shutil.copyfileobj(resp, out)
     if verbose > 0:
         print("... done downloading pretrained model!")
+
+
+############################################################
+#  Flat Weights
+############################################################
+
+# A flat, memory-mappable alternative to Keras' HDF5 weight files, for
+# inference. The file starts with FLAT_WEIGHTS_MAGIC, the length of a JSON
+# index as a little-endian uint64 and the index itself. The index lists,
+# for each layer, its weights as [dtype, shape, offset]. The raw arrays
+# follow, each aligned to FLAT_WEIGHTS_ALIGNMENT bytes.
+FLAT_WEIGHTS_EXTENSION = ".weights"
+FLAT_WEIGHTS_MAGIC = b"MRCNNW1\n"
+FLAT_WEIGHTS_ALIGNMENT = 64
+
+
+def convert_weights_to_flat(h5_path, flat_path):
+    """Converts Keras HDF5 weights, such as mask_rcnn_coco.h5, to the flat
+    format read by load_flat_weights().
+
+    h5_path: path of the HDF5 weights file
+    flat_path: path of the flat weights file to write
+    """
+    import h5py
+
+    # Layer and weight names can be stored as bytes
+    def names(attrs, key):
+        return [n.decode('utf8') if isinstance(n, bytes) else n
+                for n in attrs[key]]
+
+    with h5py.File(h5_path, mode='r') as f:
+        g = f
+        if 'layer_names' not in g.attrs and 'model_weights' in g:
+            g = g['model_weights']
+
+        # Read all weights, layer by layer, and lay them out
+        index = OrderedDict()
+        arrays = []
+        offset = 0
+        for layer_name in names(g.attrs, 'layer_names'):
+            layer = g[layer_name]
+            entries = []
+            for weight_name in names(layer.attrs, 'weight_names'):
+                array = np.ascontiguousarray(layer[weight_name][()])
+                offset += -offset % FLAT_WEIGHTS_ALIGNMENT
+                entries.append([array.dtype.str, list(array.shape), offset])
+                arrays.append((offset, array))
+                offset += array.nbytes
+            index[layer_name] = entries
+
+    header = json.dumps(index).encode('utf8')
+    start = len(FLAT_WEIGHTS_MAGIC) + 8 + len(header)
+    start += -start % FLAT_WEIGHTS_ALIGNMENT
+    with open(flat_path, 'wb') as out:
+        out.write(FLAT_WEIGHTS_MAGIC)
+        out.write(np.uint64(len(header)).tobytes())
+        out.write(header)
+        for array_offset, array in arrays:
+            out.seek(start + array_offset)
+            out.write(array.tobytes())
+
+
+def load_flat_weights(flat_path):
+    """Opens a flat weights file written by convert_weights_to_flat().
+
+    Returns an OrderedDict of layer name -> list of weight arrays. The
+    arrays are read-only views of the memory-mapped file, so nothing is
+    read from disk until they're used.
+    """
+    with open(flat_path, 'rb') as f:
+        magic = f.read(len(FLAT_WEIGHTS_MAGIC))
+        if magic != FLAT_WEIGHTS_MAGIC:
+            raise ValueError("Not a flat weights file: " + flat_path)
+        header_length = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        index = json.loads(f.read(header_length).decode('utf8'),
+                           object_pairs_hook=OrderedDict)
+    start = len(FLAT_WEIGHTS_MAGIC) + 8 + header_length
+    start += -start % FLAT_WEIGHTS_ALIGNMENT
+
+    data = np.memmap(flat_path, dtype=np.uint8, mode='r')
+    weights = OrderedDict()
+    for layer_name, entries in index.items():
+        weights[layer_name] = [
+            np.ndarray(shape, dtype=np.dtype(dtype), buffer=data,
+                       offset=start + offset)
+            for dtype, shape, offset in entries]
+    return weights